@@ -0,0 +1,374 @@
+# Benchmarks for har-downloader.py, run entirely against local stand-in
+# servers.
+#
+# gen-har writes a synthetic HAR file: a configurable number of entries,
+# spread over a number of hosts, with asset sizes drawn from a fixed or
+# lognormal distribution. Each host is a port on 127.0.0.1. With
+# --embed-bodies, the response bodies are embedded (base64) the way Firefox
+# does it, and --size-mb keeps adding entries until the file is that big.
+#
+# serve runs the stand-in hosts: one HTTP/1.1 server per port, with
+# configurable per-host latency, per-connection bandwidth and error injection.
+# Asset bodies are generated from the URL, so nothing needs to be on disk.
+# They support keep-alive, Range/If-Range and ETag/If-None-Match.
+#
+# run does both, then runs har-downloader.py against them and reports wall
+# time, throughput and peak memory. Any arguments after -- are passed on to
+# har-downloader.py.
+#
+# parse measures how long it takes until the first download could start, and
+# the peak RSS of the process, for a plain json.load() of the whole file and
+# for har-downloader.py (via --dry-run). For json.load() that's when the
+# first URL comes out; har-downloader.py plans every download before it
+# starts any, so for it that's when the plan is printed. Both have read the
+# whole HAR by then: what the streaming parser saves is memory. On a 1 GiB
+# HAR (3071 entries with 256 KiB bodies embedded):
+#
+#   parser                        ready (s)  total (s)  peak RSS (MiB)
+#   json.load                          4.17       4.24            2069
+#   har-downloader.py                  3.12       3.14              29
+#
+# Example usage:
+#   python ./har-downloader-bench.py run --entries 2000 --hosts 20 \
+#       --latency-ms 20,50,200 -- --max-concurrency 16 --cooldown-seconds 0.1
+#   python ./har-downloader-bench.py gen-har --embed-bodies --size-mb 2048 \
+#       /tmp/big.har
+#   python ./har-downloader-bench.py parse /tmp/big.har
+
+from urllib.parse import urlparse
+import argparse
+import base64
+import http.server
+import json
+import math
+import os
+import os.path
+import random
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import zlib
+
+_HAR_DOWNLOADER = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                               'har-downloader.py')
+
+# Reads the whole HAR the way har-downloader.py used to, then prints the first
+# URL.
+_JSON_LOAD_SCRIPT = '''
+import json, sys
+with open(sys.argv[1]) as fh:
+    data = json.load(fh)
+for entry in data['log']['entries']:
+    print(entry['request']['url'], flush=True)
+'''
+
+# Asset paths end in -SIZE.bin, which is how the stand-in server knows how
+# many bytes to send.
+_ASSET_SIZE = re.compile(r'-(\d+)\.bin$')
+# How much the stand-in server writes at a time.
+_WRITE_SIZE = 1 << 16
+
+
+def asset_body(path, size):
+    """Returns the (deterministic) body of the asset at path."""
+    return random.Random(path).randbytes(size)
+
+
+def asset_sizes(args, rng):
+    """Yields asset sizes in bytes, according to --size-kb and --size-dist."""
+    mean = args.size_kb * 1024
+    while True:
+        if args.size_dist == 'fixed':
+            yield mean
+        else:
+            # Lognormal with the requested mean: a few big assets, lots of
+            # small ones, like real pages.
+            sigma = 1.0
+            yield max(1, int(rng.lognormvariate(0, sigma) * mean /
+                             math.exp(sigma * sigma / 2)))
+
+
+def gen_har(args):
+    rng = random.Random(args.seed)
+    sizes = asset_sizes(args, rng)
+    target = args.size_mb * 2**20 if args.size_mb else None
+    written, count = 0, 0
+    with open(args.output, 'w') as fh:
+        fh.write('{"log": {"version": "1.2", '
+                 '"creator": {"name": "har-downloader-bench", "version": "1"}, '
+                 '"entries": [\n')
+        while (count < args.entries if target is None else written < target):
+            size = next(sizes)
+            port = args.base_port + rng.randrange(args.hosts)
+            path = f'/assets/{count}-{size}.bin'
+            entry = {
+                'request': {
+                    'method': 'GET',
+                    'url': f'http://127.0.0.1:{port}{path}',
+                },
+                'response': {
+                    'status': 200,
+                    'content': {
+                        'size': size,
+                        'mimeType': 'application/octet-stream',
+                    },
+                },
+            }
+            if args.embed_bodies:
+                entry['response']['content'].update(
+                    encoding='base64',
+                    text=base64.b64encode(asset_body(path,
+                                                     size)).decode('ascii'))
+            line = ('' if count == 0 else ',\n') + json.dumps(entry)
+            fh.write(line)
+            written += len(line)
+            count += 1
+        fh.write('\n]}}\n')
+    print(f'Wrote {count} entries ({written / 2**20:.0f} MiB) to {args.output}')
+
+
+class StandInHandler(http.server.BaseHTTPRequestHandler):
+    """Serves synthetic assets, with the latency, bandwidth and errors
+    configured on the server."""
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        server = self.server
+        time.sleep(server.latency)
+        if server.rng.random() < server.error_rate:
+            self.send_error(503)
+            return
+        path = urlparse(self.path).path
+        m = _ASSET_SIZE.search(path)
+        if m is None:
+            self.send_error(404)
+            return
+        body = asset_body(path, int(m.group(1)))
+        etag = '"%08x"' % zlib.crc32(body)
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+
+        start = 0
+        m = re.match(r'bytes=(\d+)-$', self.headers.get('Range', ''))
+        if self.headers.get('If-Range', etag) != etag:
+            # The client's partial copy is of something else.
+            m = None
+        if m is not None:
+            start = int(m.group(1))
+            if start >= len(body):
+                self.send_response(416)
+                self.send_header('Content-Range', f'bytes */{len(body)}')
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            self.send_response(206)
+            self.send_header('Content-Range',
+                             f'bytes {start}-{len(body) - 1}/{len(body)}')
+        else:
+            self.send_response(200)
+        self.send_header('ETag', etag)
+        self.send_header('Content-Length', str(len(body) - start))
+        self.end_headers()
+
+        for offset in range(start, len(body), _WRITE_SIZE):
+            chunk = body[offset:offset + _WRITE_SIZE]
+            self.wfile.write(chunk)
+            if server.bandwidth:
+                time.sleep(len(chunk) / server.bandwidth)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_servers(args):
+    """Starts a stand-in server per host, on background threads. Returns the
+    servers."""
+    latencies = [float(ms) / 1000 for ms in args.latency_ms.split(',')]
+    servers = []
+    for i in range(args.hosts):
+        server = http.server.ThreadingHTTPServer(
+            ('127.0.0.1', args.base_port + i), StandInHandler)
+        server.daemon_threads = True
+        server.latency = latencies[i % len(latencies)]
+        server.bandwidth = args.bandwidth_kbps * 1024
+        server.error_rate = args.error_rate
+        server.rng = random.Random(args.seed + i)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+    return servers
+
+
+def serve(args):
+    start_servers(args)
+    print(f'Serving {args.hosts} hosts on 127.0.0.1:{args.base_port}-'
+          f'{args.base_port + args.hosts - 1}. Ctrl-C to stop.')
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        pass
+
+
+def measure(argv, first_line_marker=None):
+    """Runs argv, and returns (seconds until the first stdout line containing
+    first_line_marker, total seconds, peak RSS in MiB)."""
+    start = time.monotonic()
+    proc = subprocess.Popen(argv, stdout=subprocess.PIPE, text=True)
+    first = None
+    for line in proc.stdout:
+        if first is None and first_line_marker and first_line_marker in line:
+            first = time.monotonic() - start
+    _, status, rusage = os.wait4(proc.pid, 0)
+    proc.returncode = os.waitstatus_to_exitcode(status)
+    total = time.monotonic() - start
+    if proc.returncode not in (0, 1):
+        raise RuntimeError(f'{argv} exited with status {proc.returncode}')
+    # ru_maxrss is in KiB on Linux.
+    return first, total, rusage.ru_maxrss / 1024
+
+
+def run(args):
+    workdir = tempfile.mkdtemp(prefix='har-downloader-bench.')
+    try:
+        args.output = os.path.join(workdir, 'bench.har')
+        gen_har(args)
+        # The servers run on daemon threads, and go away when we exit.
+        start_servers(args)
+        stats_file = os.path.join(workdir, 'stats.json')
+        argv = [
+            sys.executable, _HAR_DOWNLOADER, '--progress-seconds', '0',
+            '--stats-json', stats_file
+        ] + args.downloader_args + [args.output, os.path.join(workdir, 'out')]
+        print(' '.join(argv[1:]))
+        _, wall, rss = measure(argv)
+        with open(stats_file) as fh:
+            stats = json.load(fh)
+    finally:
+        shutil.rmtree(workdir)
+
+    print(f'wall time:      {wall:.2f}s')
+    print(f'downloaded:     {stats["requests"]} requests, '
+          f'{stats["bytes"] / 2**20:.1f} MiB')
+    print(f'throughput:     {stats["bytes"] / 2**20 / wall:.2f} MiB/s, '
+          f'{stats["requests"] / wall:.1f} requests/s')
+    print(f'errors:         {stats["errors"]}')
+    print(f'worker time:    {stats["transfer_seconds"]:.1f}s in requests, '
+          f'{stats["cooldown_seconds"]:.1f}s in cooldown')
+    print(f'peak RSS:       {rss:.0f} MiB')
+
+
+def parse(args):
+    size = os.stat(args.har_file).st_size / 2**20
+    print(f'{args.har_file}: {size:.0f} MiB')
+    print(f'{"parser":<24} {"ready (s)":>14} {"total (s)":>10} '
+          f'{"peak RSS (MiB)":>15}')
+    runs = [
+        ('json.load', [sys.executable, '-c', _JSON_LOAD_SCRIPT,
+                       args.har_file], '://'),
+        ('har-downloader.py', [
+            sys.executable, _HAR_DOWNLOADER, '--dry-run', args.har_file,
+            tempfile.mkdtemp(prefix='har-downloader-bench.')
+        ], 'Plan: '),
+    ]
+    for name, argv, marker in runs:
+        first, total, rss = measure(argv, marker)
+        print(f'{name:<24} {first:>14.2f} {total:>10.2f} {rss:>15.0f}')
+        if name == 'har-downloader.py':
+            os.rmdir(argv[-1])
+
+
+def add_har_args(parser):
+    parser.add_argument('--entries',
+                        help='Number of entries in the HAR.',
+                        type=int,
+                        default=1000)
+    parser.add_argument('--size-mb',
+                        help='Instead of --entries, keep adding entries '
+                        'until the HAR file is about this big.',
+                        type=int)
+    parser.add_argument('--size-kb',
+                        help='Mean asset size.',
+                        type=int,
+                        default=64)
+    parser.add_argument('--size-dist',
+                        help='Distribution of asset sizes.',
+                        choices=['fixed', 'lognormal'],
+                        default='lognormal')
+    parser.add_argument('--embed-bodies',
+                        help='Embed base64 response bodies in the HAR.',
+                        action='store_true')
+    parser.add_argument('--seed', type=int, default=0)
+
+
+def add_server_args(parser):
+    parser.add_argument('--hosts',
+                        help='Number of distinct hosts.',
+                        type=int,
+                        default=40)
+    parser.add_argument('--base-port',
+                        help='Host i is served on port base-port + i.',
+                        type=int,
+                        default=18000)
+    parser.add_argument('--latency-ms',
+                        help='Latency added to each request, in ms. A comma '
+                        'separated list is assigned to hosts round-robin.',
+                        default='20')
+    parser.add_argument('--bandwidth-kbps',
+                        help='Per-connection bandwidth limit in KiB/s. 0 '
+                        'means unlimited.',
+                        type=float,
+                        default=0)
+    parser.add_argument('--error-rate',
+                        help='Fraction of requests answered with a 503.',
+                        type=float,
+                        default=0)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    gen = subparsers.add_parser('gen-har', help='Write a synthetic HAR file.')
+    gen.add_argument('output')
+    add_har_args(gen)
+    gen.add_argument('--hosts',
+                     help='Number of distinct hosts.',
+                     type=int,
+                     default=40)
+    gen.add_argument('--base-port', type=int, default=18000)
+    gen.set_defaults(func=gen_har)
+
+    srv = subparsers.add_parser('serve', help='Run the stand-in hosts.')
+    add_server_args(srv)
+    srv.add_argument('--seed', type=int, default=0)
+    srv.set_defaults(func=serve)
+
+    rn = subparsers.add_parser(
+        'run', help='Benchmark har-downloader.py against stand-in hosts.')
+    add_har_args(rn)
+    add_server_args(rn)
+    rn.add_argument('downloader_args',
+                    nargs='*',
+                    help='Extra arguments for har-downloader.py, after --.')
+    rn.set_defaults(func=run)
+
+    par = subparsers.add_parser(
+        'parse', help='Compare time until downloads could start and peak RSS '
+        'of HAR parsers.')
+    par.add_argument('har_file')
+    par.set_defaults(func=parse)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
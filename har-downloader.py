@@ -6,78 +6,1058 @@
 #
 # Files are organized by domain name. Any files that already exist in the
 # output dir are not re-downloaded -- this way, you can recover from
-# interruptions.
+# interruptions. Before downloading anything we read the whole HAR and print a
+# plan of how many files need fetching; URLs requested several times are only
+# fetched once. Downloads are streamed to a .part file that is renamed into
+# place when complete, and an interrupted .part file is resumed with a Range
+# request the next time around. The ETag or Last-Modified it came with is kept
+# next to it and sent as If-Range, so that if the file has changed since, the
+# server sends all of it again instead of the rest of the new one.
 #
-# There is a configurable cooldown interval to be nice to the remote server.
+# Downloads run concurrently (see --max-concurrency), but each host is only
+# ever sent one request at a time, over a reused keep-alive connection. There
+# is a configurable cooldown interval between requests to the same host, to be
+# nice to the remote server; other hosts keep downloading in the meantime.
+#
+# Many HARs also embed the response bodies themselves. With --use-embedded,
+# those are written straight to the output dir and only entries without a body
+# are downloaded; --offline never touches the network at all.
+#
+# With --blob-store, each file is stored once under its SHA-256 in a
+# content-addressed store, and destination/netloc/path is a hardlink (or
+# reflink) to it. Identical bytes served under different URLs then take up the
+# space of one copy. The store's index.jsonl maps each URL to its digest.
+#
+# The ETag, Last-Modified, size and SHA-256 of every file we write are kept in
+# a manifest in the output dir. With --refresh, files that already exist are
+# revalidated with a conditional request instead of being skipped, so
+# unchanged files only cost a 304.
+#
+# While downloading, a progress line with throughput and where the workers'
+# time is going is printed every --progress-seconds. --stats-json writes the
+# final numbers, including per-host latency and time-to-first-byte
+# percentiles and error counts by status, to a file.
+#
+# Several HAR files (or directories of them) can be given at once. They are
+# parsed in parallel worker processes, and their URLs merged into a single
+# deduplicated download plan.
 #
 # Example usage:
 #   python ./har-downloader.py myharfile.har mydir
+#   python ./har-downloader.py captures/ more.har mydir
+#   python ./har-downloader.py --offline myharfile.har mydir
+#   python ./har-downloader.py --blob-store blobs myharfile.har mydir
+#   python ./har-downloader.py --refresh myharfile.har mydir
 
-from urllib.parse import urlparse
-from urllib.request import urlopen
+from urllib.error import HTTPError
+from urllib.parse import urljoin, urlparse
+import argparse
+import base64
+import collections
+import concurrent.futures
+import contextlib
+import errno
+import fcntl
+import hashlib
+import heapq
+import http.client
+import itertools
 import json
+import multiprocessing
 import os
 import os.path
 import random
-import shlex
+import re
+import shutil
 import sys
+import threading
 import time
-import argparse
 
+# Statuses we follow to the URL in the Location header.
+_REDIRECT_STATUSES = (301, 302, 303, 307, 308)
+_MAX_REDIRECTS = 5
+# How much of the HAR file to read at a time.
+_CHUNK_SIZE = 1 << 20
+_NON_WHITESPACE = re.compile(r'\S')
+# How much of a response body to read and write at a time.
+_COPY_SIZE = 1 << 16
+# Suffix for files that are still being written.
+_PART_SUFFIX = '.part'
+# Suffix, after the .part, for the validators a partial download came with.
+_VALIDATOR_SUFFIX = '.validator'
+# Default name of the manifest, in the destination dir.
+_MANIFEST = '.har-downloader-manifest.jsonl'
+# ioctl to make a copy-on-write clone of a file (Linux, on btrfs/xfs/etc.)
+_FICLONE = 0x40049409
 
-def read_har(args):
-    with open(args.har_file, 'r') as fh:
-        data = json.load(fh)
 
-    urls = []
-    skipped = 0
-    for entry in data['log']['entries']:
-        url = entry['request']['url']
-
-        if not url.startswith('http:') and not url.startswith('https:'):
-            print(f'Skipping non-HTTP URL {url}')
-            skipped += 1
-        elif url.endswith('/'):
-            print(f'Skipping directory {url}')
-            skipped += 1
-        if args.url_pattern is None or args.url_pattern in url:
-            urls.append(url)
-        else:
-            print(f'Skipping non-matcihng URL: {url}')
-            skipped += 1
+class HarReader:
+    """Incrementally parses the entries out of a HAR file.
+
+    HARs with embedded response bodies can be many GB, so rather than
+    json.load() the whole thing, we walk the top-level structure by hand and
+    only decode one value at a time: each entry in log.entries, and any other
+    value we skip over on the way. Memory use is bounded by the largest single
+    entry, not the size of the file.
+    """
+
+    def __init__(self, fh, chunk_size=_CHUNK_SIZE):
+        self.fh = fh
+        self.chunk_size = chunk_size
+        self.decoder = json.JSONDecoder()
+        self.buf = ''
+        self.pos = 0
+        self.eof = False
+
+    def _read_more(self, size):
+        """Appends up to size more characters to the buffer, dropping the part
+        we've already consumed. Returns False at end of file."""
+        self.buf = self.buf[self.pos:]
+        self.pos = 0
+        chunk = self.fh.read(size)
+        if not chunk:
+            self.eof = True
+            return False
+        self.buf += chunk
+        return True
+
+    def _peek(self):
+        """Skips whitespace and returns the next character, without consuming
+        it."""
+        while True:
+            m = _NON_WHITESPACE.search(self.buf, self.pos)
+            if m is not None:
+                self.pos = m.start()
+                return self.buf[self.pos]
+            self.pos = len(self.buf)
+            if not self._read_more(self.chunk_size):
+                raise ValueError('Unexpected end of HAR file')
+
+    def _expect(self, chars):
+        """Consumes the next character, which must be one of chars."""
+        c = self._peek()
+        if c not in chars:
+            raise ValueError(f'Expected one of {chars!r} in HAR file, '
+                             f'found {c!r}')
+        self.pos += 1
+        return c
+
+    def _value(self):
+        """Decodes and consumes the next complete JSON value."""
+        self._peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buf, self.pos)
+                # A value that runs right up to the end of the buffer (e.g. a
+                # number) may continue in the next chunk.
+                if end < len(self.buf) or self.eof:
+                    self.pos = end
+                    return value
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+            # Grow geometrically, so a huge value is re-scanned only a few
+            # times.
+            self._read_more(max(self.chunk_size, len(self.buf) - self.pos))
+
+    def _keys(self):
+        """Yields each key of the object at the current position. The caller
+        must consume the corresponding value before resuming."""
+        self._expect('{')
+        if self._peek() == '}':
+            self.pos += 1
+            return
+        while True:
+            key = self._value()
+            self._expect(':')
+            yield key
+            if self._expect(',}') == '}':
+                return
+
+    def entries(self):
+        """Yields each object in log.entries, in order."""
+        for key in self._keys():
+            if key != 'log':
+                self._value()
+                continue
+            for log_key in self._keys():
+                if log_key != 'entries':
+                    self._value()
+                    continue
+                self._expect('[')
+                if self._peek() == ']':
+                    self.pos += 1
+                    continue
+                while True:
+                    yield self._value()
+                    if self._expect(',]') == ']':
+                        break
+
+
+def embedded_body(entry):
+    """Returns the response body embedded in a HAR entry as bytes, or None.
+
+    Bodies are stored in response.content.text, base64-encoded if
+    content.encoding says so. Otherwise the text has already been decoded by
+    the browser, and we write it back out as UTF-8.
+    """
+    response = entry.get('response', {})
+    content = response.get('content', {})
+    text = content.get('text')
+    # Redirects, 304s and the like have no (useful) body.
+    if response.get('status') != 200 or text is None:
+        return None
+    if content.get('encoding') == 'base64':
+        return base64.b64decode(text)
+    return text.encode('utf-8')
+
+
+def read_har(har_file, args):
+    """Yields (url, body) for each downloadable entry in the HAR, as it is
+    parsed.
+
+    body is the embedded response body if --use-embedded is set and the entry
+    has one, and None otherwise.
+    """
+    found, skipped = 0, 0
+    with open(har_file, 'r', encoding='utf-8') as fh:
+        for entry in HarReader(fh).entries():
+            url = entry['request']['url']
+
+            if not url.startswith('http:') and not url.startswith('https:'):
+                print(f'Skipping non-HTTP URL {url}')
+                skipped += 1
+            elif url.endswith('/'):
+                print(f'Skipping directory {url}')
+                skipped += 1
+            elif args.url_pattern is None or args.url_pattern in url:
+                found += 1
+                yield url, embedded_body(entry) if args.use_embedded else None
+            else:
+                print(f'Skipping non-matching URL: {url}')
+                skipped += 1
     print(
-        f'Found {len(urls)} URLs to download from {args.har_file}. Skipped {skipped}.'
+        f'Found {found} URLs to download from {har_file}. Skipped {skipped}.'
     )
-    return urls
 
 
-def download(url, destination, args):
+class ConnectionPool:
+    """Idle keep-alive connections, pooled per (scheme, netloc).
+
+    Connections are checked out with get() for a single request/response, and
+    handed back with put() once the response body has been read completely.
+    """
+
+    def __init__(self, timeout):
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.idle = collections.defaultdict(list)
+
+    def get(self, scheme, netloc):
+        with self.lock:
+            conns = self.idle[(scheme, netloc)]
+            if conns:
+                return conns.pop()
+        if scheme == 'https':
+            return http.client.HTTPSConnection(netloc, timeout=self.timeout)
+        return http.client.HTTPConnection(netloc, timeout=self.timeout)
+
+    def put(self, scheme, netloc, conn):
+        with self.lock:
+            self.idle[(scheme, netloc)].append(conn)
+
+    def close(self):
+        with self.lock:
+            for conns in self.idle.values():
+                for conn in conns:
+                    conn.close()
+            self.idle.clear()
+
+
+def _send(conn, path, headers):
+    """Sends a GET on conn and returns the response.
+
+    If conn is a reused keep-alive connection, the server may have closed it
+    while it sat in the pool. In that case we reconnect and try once more.
+    """
+    reused = conn.sock is not None
+    try:
+        conn.request('GET', path, headers=headers)
+        return conn.getresponse()
+    except (http.client.HTTPException, OSError):
+        conn.close()
+        if not reused:
+            raise
+    conn.request('GET', path, headers=headers)
+    return conn.getresponse()
+
+
+@contextlib.contextmanager
+def fetch(url, pool, headers=None):
+    """Issues a GET for url over a pooled connection, following redirects.
+
+    Yields the http.client.HTTPResponse. The connection goes back to the pool
+    if the caller reads the whole body; otherwise it is closed. Raises
+    HTTPError for 4xx and 5xx responses, like urlopen().
+    """
+    headers = dict(headers or {})
+    for _ in range(_MAX_REDIRECTS + 1):
+        parsed = urlparse(url)
+        path = parsed.path or '/'
+        if parsed.query:
+            path += '?' + parsed.query
+        conn = pool.get(parsed.scheme, parsed.netloc)
+        try:
+            response = _send(conn, path, headers)
+        except BaseException:
+            conn.close()
+            raise
+
+        try:
+            location = response.getheader('Location')
+            if response.status in _REDIRECT_STATUSES and location:
+                response.read()
+                url = urljoin(url, location)
+                continue
+            if response.status >= 400:
+                response.read()
+                raise HTTPError(url, response.status, response.reason,
+                                response.headers, None)
+            yield response
+        finally:
+            if response.isclosed() and not response.will_close:
+                pool.put(parsed.scheme, parsed.netloc, conn)
+            else:
+                conn.close()
+        return
+    raise HTTPError(url, response.status, 'Too many redirects',
+                    response.headers, None)
+
+
+def percentiles(samples):
+    """Returns the p50/p95/p99 of samples (nearest rank), rounded to ms."""
+    if not samples:
+        return {}
+    ordered = sorted(samples)
+    return {
+        f'p{p}': round(ordered[min(len(ordered) - 1,
+                                   int(len(ordered) * p / 100))], 3)
+        for p in (50, 95, 99)
+    }
+
+
+class Stats:
+    """Transfer metrics for a run, shared by all the download workers.
+
+    Times are in seconds. transfer_seconds and cooldown_seconds are summed
+    over workers: the time spent in requests, and the time spent waiting for
+    a host's cooldown to pass while no other host had work.
+    """
+
+    def __init__(self, planned):
+        self.lock = threading.Lock()
+        self.start = time.monotonic()
+        self.planned = planned
+        self.completed = 0
+        self.bytes = 0
+        self.host_bytes = collections.Counter()
+        self.latency = collections.defaultdict(list)
+        self.ttfb = collections.defaultdict(list)
+        self.errors = collections.Counter()
+        self.transfer_seconds = 0.0
+        self.cooldown_seconds = 0.0
+        # For the rate since the last progress line.
+        self.last_report = (self.start, 0)
+
+    def first_byte(self, netloc, seconds):
+        with self.lock:
+            self.ttfb[netloc].append(seconds)
+
+    def received(self, netloc, nbytes):
+        with self.lock:
+            self.bytes += nbytes
+            self.host_bytes[netloc] += nbytes
+
+    def request(self, netloc, seconds, error=None):
+        """Records a finished request, and its status code or exception name
+        if it failed."""
+        with self.lock:
+            self.completed += 1
+            self.latency[netloc].append(seconds)
+            self.transfer_seconds += seconds
+            if error is not None:
+                self.errors[str(error)] += 1
+
+    def cooling_down(self, seconds):
+        with self.lock:
+            self.cooldown_seconds += seconds
+
+    def progress_line(self):
+        with self.lock:
+            now = time.monotonic()
+            last_time, last_bytes = self.last_report
+            rate = (self.bytes - last_bytes) / max(now - last_time, 1e-9)
+            self.last_report = (now, self.bytes)
+            busy = self.transfer_seconds + self.cooldown_seconds
+            return (f"[progress] {self.completed}/{self.planned} requests, "
+                    f"{self.bytes / 2**20:.1f} MiB, {rate / 2**20:.2f} MiB/s, "
+                    f"{sum(self.errors.values())} errors, "
+                    f"transfer {self.transfer_seconds:.0f}s / "
+                    f"cooldown {self.cooldown_seconds:.0f}s of worker time"
+                    + (f" ({100 * self.cooldown_seconds / busy:.0f}% cooldown)"
+                       if busy else ""))
+
+    def summary(self):
+        with self.lock:
+            elapsed = time.monotonic() - self.start
+            return {
+                'elapsed_seconds': round(elapsed, 3),
+                'requests': self.completed,
+                'bytes': self.bytes,
+                'bytes_per_second': round(self.bytes / max(elapsed, 1e-9)),
+                'transfer_seconds': round(self.transfer_seconds, 3),
+                'cooldown_seconds': round(self.cooldown_seconds, 3),
+                'errors': dict(self.errors),
+                'hosts': {
+                    netloc: {
+                        'requests': len(self.latency[netloc]),
+                        'bytes': self.host_bytes[netloc],
+                        'latency': percentiles(self.latency[netloc]),
+                        'ttfb': percentiles(self.ttfb[netloc]),
+                    }
+                    for netloc in sorted(self.latency)
+                },
+            }
+
+
+def report_progress(stats, interval, stop):
+    while not stop.wait(interval):
+        print(stats.progress_line())
+
+
+class HostScheduler:
+    """Hands out queued URLs to download workers, one host at a time.
+
+    Each host (netloc) has its own queue. A host is given to at most one
+    worker at a time, and after a request it isn't eligible again until its
+    cooldown has passed. That way --cooldown-seconds is applied to each server
+    separately, while workers move on to other hosts in the meantime.
+    """
+
+    def __init__(self, stats):
+        self.stats = stats
+        self.cond = threading.Condition()
+        self.queues = collections.defaultdict(collections.deque)
+        # Hosts with queued URLs that no worker has: (ready time, netloc).
+        self.ready = []
+        # Hosts that are either in self.ready or checked out by a worker.
+        self.scheduled = set()
+        # Earliest time each host may be contacted again.
+        self.not_before = {}
+        self.closed = False
+
+    def add(self, netloc, item):
+        with self.cond:
+            self.queues[netloc].append(item)
+            if netloc not in self.scheduled:
+                self.scheduled.add(netloc)
+                heapq.heappush(self.ready,
+                               (self.not_before.get(netloc, 0), netloc))
+                self.cond.notify()
+
+    def close(self):
+        """Signals that no more URLs will be added."""
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+
+    def next(self):
+        """Blocks until a host is ready, and returns (netloc, item).
+
+        Returns None once the scheduler is closed and every queue is drained.
+        """
+        with self.cond:
+            while True:
+                now = time.monotonic()
+                if self.ready:
+                    ready_at, netloc = self.ready[0]
+                    if ready_at <= now:
+                        heapq.heappop(self.ready)
+                        return netloc, self.queues[netloc].popleft()
+                    self.cond.wait(ready_at - now)
+                    self.stats.cooling_down(time.monotonic() - now)
+                elif self.closed and not self.scheduled:
+                    return None
+                else:
+                    self.cond.wait()
+
+    def done(self, netloc, cooldown):
+        """Returns a host checked out by next(), to be reused after cooldown
+        seconds."""
+        with self.cond:
+            ready_at = time.monotonic() + cooldown
+            self.not_before[netloc] = ready_at
+            if self.queues[netloc]:
+                heapq.heappush(self.ready, (ready_at, netloc))
+            else:
+                del self.queues[netloc]
+                self.scheduled.discard(netloc)
+            self.cond.notify_all()
+
+
+class BlobStore:
+    """A content-addressed store of downloaded files, keyed by SHA-256.
+
+    Blobs live in root/objects/ab/cdef..., and index.jsonl has one
+    {"url": ..., "sha256": ..., "size": ...} line per file added. A store can
+    be shared between several destination dirs.
+    """
+
+    def __init__(self, root, link_mode):
+        self.root = root
+        self.link_mode = link_mode
+        self.lock = threading.Lock()
+        os.makedirs(os.path.join(root, 'objects'), exist_ok=True)
+        self.index = open(os.path.join(root, 'index.jsonl'), 'a')
+
+    def blob_path(self, digest):
+        return os.path.join(self.root, 'objects', digest[:2], digest[2:])
+
+    def add(self, url, part_file, dest_file, digest):
+        """Moves part_file into the store, unless we already have those bytes,
+        and materializes dest_file as a link to the blob."""
+        blob = self.blob_path(digest)
+        if os.path.exists(blob):
+            os.unlink(part_file)
+        else:
+            os.makedirs(os.path.dirname(blob), exist_ok=True)
+            _move(part_file, blob)
+        _link(blob, dest_file + _PART_SUFFIX, self.link_mode)
+        os.replace(dest_file + _PART_SUFFIX, dest_file)
+        line = json.dumps({
+            'url': url,
+            'sha256': digest,
+            'size': os.stat(blob).st_size
+        })
+        with self.lock:
+            self.index.write(line + '\n')
+            self.index.flush()
+
+    def close(self):
+        self.index.close()
+
+
+class Manifest:
+    """What we know about each file we've written, keyed by URL.
+
+    Each record has the file's ETag and Last-Modified (if the server sent
+    them), its size and its SHA-256. Records are appended to a JSON-lines file
+    as files are completed, so an interrupted run loses nothing; the last
+    record for a URL wins.
+    """
+
+    def __init__(self, path, readonly):
+        self.path = path
+        self.lock = threading.Lock()
+        self.records, _ = self._load()
+        self.fh = None
+        if not readonly:
+            os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+            self.fh = open(path, 'a')
+
+    def _load(self):
+        """Returns the latest record for each URL in the file, and how many
+        lines the file has."""
+        records, lines = {}, 0
+        try:
+            with open(self.path) as fh:
+                for line in fh:
+                    lines += 1
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # Most likely a line cut short by a crash.
+                        continue
+                    records[record['url']] = record
+        except FileNotFoundError:
+            pass
+        return records, lines
+
+    def get(self, url):
+        with self.lock:
+            return self.records.get(url)
+
+    def conditional_headers(self, url):
+        """Returns the headers to revalidate our copy of url, if we know its
+        validators."""
+        record = self.get(url) or {}
+        headers = {}
+        if record.get('etag'):
+            headers['If-None-Match'] = record['etag']
+        if record.get('last_modified'):
+            headers['If-Modified-Since'] = record['last_modified']
+        return headers
+
+    def add(self, url, headers, digest, size):
+        """Records a completed file. headers are the response headers it came
+        with, if any."""
+        record = {
+            'url': url,
+            'etag': headers.get('ETag') if headers else None,
+            'last_modified': headers.get('Last-Modified') if headers else None,
+            'size': size,
+            'sha256': digest,
+        }
+        line = json.dumps(record)
+        with self.lock:
+            self.records[url] = record
+            self.fh.write(line + '\n')
+            self.fh.flush()
+
+    def close(self, compact=True):
+        """Closes the manifest. If compact is true, rewrites it without
+        superseded records if they make up most of it.
+
+        Other processes may have appended to the file too (see scan_har()), so
+        only compact once they are done.
+        """
+        if self.fh is None:
+            return
+        self.fh.close()
+        if not compact:
+            return
+        records, lines = self._load()
+        if lines <= 2 * len(records):
+            return
+        tmp = self.path + _PART_SUFFIX
+        with open(tmp, 'w') as fh:
+            for record in records.values():
+                fh.write(json.dumps(record) + '\n')
+        os.replace(tmp, self.path)
+
+
+def _move(src, dst):
+    """os.replace(), falling back to a copy across filesystems."""
+    try:
+        os.replace(src, dst)
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+        shutil.copyfile(src, dst + _PART_SUFFIX)
+        os.replace(dst + _PART_SUFFIX, dst)
+        os.unlink(src)
+
+
+def _link(src, dst, mode):
+    """Makes dst a hardlink or reflink of src, falling back to a plain copy if
+    the filesystem can't do that."""
+    if mode == 'hardlink':
+        try:
+            os.link(src, dst)
+            return
+        except FileExistsError:
+            os.unlink(dst)
+            os.link(src, dst)
+            return
+        except OSError as e:
+            if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+                raise
+    elif mode == 'reflink':
+        with open(src, 'rb') as src_fh, open(dst, 'wb') as dst_fh:
+            try:
+                fcntl.ioctl(dst_fh.fileno(), _FICLONE, src_fh.fileno())
+                return
+            except OSError as e:
+                if e.errno not in (errno.EXDEV, errno.EOPNOTSUPP,
+                                   errno.ENOTTY, errno.EINVAL):
+                    raise
+    shutil.copyfile(src, dst)
+
+
+def finish(url, part_file, dest_file, digest, store):
+    """Puts a completely written part_file in place as dest_file."""
+    if store is None:
+        os.replace(part_file, dest_file)
+    else:
+        store.add(url, part_file, dest_file, digest)
+
+
+def local_path(url, destination, args):
+    """Returns where the file for url goes: destination/netloc/path."""
     parsed = urlparse(url)
     dest_file = os.path.join(destination, parsed.netloc, parsed.path[1:])
     if args.save_query_string and parsed.query:
         dest_file = dest_file + '?' + parsed.query
-    print(f"{url} -> {dest_file}")
-    if args.dry_run:
-        return False
+    return dest_file
+
+
+class Planner:
+    """Works out which files a run will write, before any network I/O.
+
+    Each target path is only handed out once, however many times its URL
+    appears in the HAR. Rather than stat() every target, we list each
+    destination directory once with os.scandir() and check names against
+    that, creating the directory instead if it doesn't exist yet.
+    """
+
+    def __init__(self, args):
+        self.args = args
+        self.seen = set()
+        self.listings = {}
+
+    def _listing(self, directory):
+        names = self.listings.get(directory)
+        if names is None:
+            try:
+                with os.scandir(directory) as it:
+                    names = {entry.name for entry in it}
+            except FileNotFoundError:
+                if not self.args.dry_run:
+                    # Other scan_har() processes may be creating it too.
+                    os.makedirs(directory, exist_ok=True)
+                names = set()
+            self.listings[directory] = names
+        return names
+
+    def add(self, dest_file):
+        """Returns whether dest_file already exists, or None if it has been
+        added before."""
+        if dest_file in self.seen:
+            return None
+        self.seen.add(dest_file)
+        directory, name = os.path.split(dest_file)
+        return name in self._listing(directory)
+
+
+# A file to download: url goes to dest_file, which exists if present is true.
+Download = collections.namedtuple('Download', 'url dest_file present')
+
+
+def extract(url, body, dest_file, present, args, store, manifest):
+    """Writes a body embedded in the HAR to where download() would put it.
+
+    Returns 'extracted', 'existing' or 'unchanged', like download().
+    """
+    print(f"{url} -> {dest_file} (embedded)")
+    digest = hashlib.sha256(body).hexdigest()
+    if present:
+        if not args.refresh:
+            print(f"    SKIPPING: {dest_file} already exists")
+            return 'existing'
+        record = manifest.get(url)
+        if record is not None and record['sha256'] == digest:
+            print(f"    UNCHANGED: {dest_file}")
+            return 'unchanged'
+
+    # Unlike a download, there's nothing to resume, so each writer gets a part
+    # file of its own.
+    part_file = f'{dest_file}.{os.getpid()}{_PART_SUFFIX}'
+    with open(part_file, 'wb') as fh:
+        fh.write(body)
+    finish(url, part_file, dest_file, digest, store)
+    manifest.add(url, None, digest, len(body))
+    return 'extracted'
 
-    shlex.os.makedirs(os.path.dirname(dest_file), exist_ok=True)
-    exists = False
+
+def _resume_offset(response, offset):
+    """Returns where in the file the body of response starts.
+
+    We only asked for a Range if offset is nonzero, and servers are free to
+    ignore it and send the whole thing.
+    """
+    if not offset or response.status != 206:
+        return 0
+    m = re.match(r'bytes (\d+)-', response.getheader('Content-Range', ''))
+    if m is None or int(m.group(1)) != offset:
+        return 0
+    return offset
+
+
+def _if_range(part_file):
+    """Returns the If-Range value to resume part_file with, or None if we
+    don't know which version of the file it's part of."""
+    try:
+        with open(part_file + _VALIDATOR_SUFFIX) as fh:
+            saved = json.load(fh)
+    except (FileNotFoundError, ValueError):
+        return None
+    etag = saved.get('etag')
+    # If-Range only takes strong ETags.
+    if etag and not etag.startswith('W/'):
+        return etag
+    return saved.get('last_modified')
+
+
+def _save_validators(part_file, headers):
+    """Records the validators of the response part_file is being written
+    from, for _if_range()."""
+    path = part_file + _VALIDATOR_SUFFIX
+    saved = {
+        'etag': headers.get('ETag'),
+        'last_modified': headers.get('Last-Modified'),
+    }
+    if not any(saved.values()):
+        _remove(path)
+        return
+    with open(path, 'w') as fh:
+        json.dump(saved, fh)
+
+
+def _remove(path):
     try:
-        os.stat(dest_file)
-        print(f"    SKIPPING: already exists")
-        return False
+        os.unlink(path)
     except FileNotFoundError:
         pass
 
-    with urlopen(url) as response:
-        with open(dest_file, 'wb') as fh:
-            fh.write(response.read())
-    return True
+
+def _hash_file(path, digest):
+    """Feeds the contents of path to digest, and returns its size."""
+    size = 0
+    with open(path, 'rb') as fh:
+        while True:
+            chunk = fh.read(_COPY_SIZE)
+            if not chunk:
+                return size
+            digest.update(chunk)
+            size += len(chunk)
+
+
+def fetch_to_file(url, part_file, pool, stats, conditional_headers=None):
+    """Streams url into part_file, resuming from its current size if it
+    already exists and we know which version of url it came from.
+
+    Returns (SHA-256 hex digest, size, response headers) for the complete
+    file, or None if conditional_headers were given and the server says our
+    copy is still current.
+    """
+    digest = hashlib.sha256()
+    try:
+        offset = _hash_file(part_file, digest)
+    except FileNotFoundError:
+        offset = 0
+    headers = dict(conditional_headers or {})
+    if_range = _if_range(part_file) if offset else None
+    if if_range:
+        headers['Range'] = f'bytes={offset}-'
+        headers['If-Range'] = if_range
+    else:
+        offset = 0
+    netloc = urlparse(url).netloc
+    start = time.monotonic()
+    try:
+        with fetch(url, pool, headers) as response:
+            stats.first_byte(netloc, time.monotonic() - start)
+            if response.status == 304:
+                response.read()
+                _remove(part_file)
+                _remove(part_file + _VALIDATOR_SUFFIX)
+                return None
+            offset = _resume_offset(response, offset)
+            if offset:
+                print(f"    RESUMING at byte {offset}")
+            else:
+                digest = hashlib.sha256()
+                _save_validators(part_file, response.headers)
+            with open(part_file, 'ab' if offset else 'wb') as fh:
+                while True:
+                    chunk = response.read(_COPY_SIZE)
+                    if not chunk:
+                        break
+                    fh.write(chunk)
+                    digest.update(chunk)
+                    stats.received(netloc, len(chunk))
+                size = fh.tell()
+            response_headers = response.headers
+    except HTTPError as e:
+        if e.code != 416 or not offset:
+            raise
+        # Our partial file is at least as long as what the server has now.
+        # It might be exactly complete; otherwise it's stale, so start over.
+        m = re.match(r'bytes \*/(\d+)$', e.headers.get('Content-Range', ''))
+        if m is None or int(m.group(1)) != offset:
+            os.unlink(part_file)
+            return fetch_to_file(url, part_file, pool, stats,
+                                 conditional_headers)
+        size, response_headers = offset, e.headers
+    _remove(part_file + _VALIDATOR_SUFFIX)
+    return digest.hexdigest(), size, response_headers
+
+
+def download(task, pool, store, manifest, stats):
+    """Downloads task.url to task.dest_file.
+
+    If the file is already present (with --refresh), we make a conditional
+    request. Returns 'downloaded' or 'unchanged' (the server said our copy is
+    current).
+    """
+    url, dest_file = task.url, task.dest_file
+    print(f"{url} -> {dest_file}")
+    conditional_headers = None
+    if task.present:
+        conditional_headers = manifest.conditional_headers(url)
+
+    part_file = dest_file + _PART_SUFFIX
+    fetched = fetch_to_file(url, part_file, pool, stats, conditional_headers)
+    if fetched is None:
+        print(f"    UNCHANGED: {dest_file}")
+        return 'unchanged'
+    digest, size, headers = fetched
+    finish(url, part_file, dest_file, digest, store)
+    manifest.add(url, headers, digest, size)
+    return 'downloaded'
+
+
+def cooldown(args):
+    """Returns the time to wait before contacting a host again, with up to 50%
+    jitter."""
+    return args.cooldown_seconds + (0.5 * args.cooldown_seconds *
+                                    random.random())
+
+
+def find_hars(paths):
+    """Expands directories in paths to the .har files in them."""
+    har_files = []
+    for path in paths:
+        if os.path.isdir(path):
+            har_files.extend(
+                sorted(
+                    os.path.join(path, name) for name in os.listdir(path)
+                    if name.endswith('.har')))
+        else:
+            har_files.append(path)
+    return har_files
+
+
+def manifest_path(args):
+    return args.manifest or os.path.join(args.destination_dir, _MANIFEST)
+
+
+def scan_har(har_file, args, store=None, manifest=None, claims=None,
+             index=0):
+    """Reads one HAR, writing out its embedded bodies (with --use-embedded).
+
+    Returns (URLs that need the network, Counter of what happened to the
+    other entries). When there are several HARs this runs in a worker
+    process, and opens its own blob store and manifest. claims is then a
+    dict shared by all of them, from each embedded body's dest_file to the
+    index of the HAR that gets to write it; the others count it as a
+    duplicate.
+    """
+    own = manifest is None
+    if own:
+        if args.blob_store and not args.dry_run:
+            store = BlobStore(args.blob_store, args.blob_link)
+        manifest = Manifest(manifest_path(args), readonly=args.dry_run)
+    planner = Planner(args)
+    urls = []
+    totals = collections.Counter()
+    try:
+        for url, body in read_har(har_file, args):
+            if body is None:
+                if args.offline:
+                    print(f"{url}: no embedded body, SKIPPING (--offline)")
+                    totals['unavailable'] += 1
+                else:
+                    urls.append(url)
+                continue
+            dest_file = local_path(url, args.destination_dir, args)
+            try:
+                present = planner.add(dest_file)
+            except OSError as e:
+                print(f"{url}: FAILED: {e}")
+                totals['failed'] += 1
+                continue
+            if present is None or (claims is not None and
+                                   claims.setdefault(dest_file, index) != index):
+                totals['duplicate'] += 1
+            elif args.dry_run:
+                print(f"{url} -> {dest_file} (embedded)")
+                totals['extracted'] += 1
+            else:
+                totals[extract(url, body, dest_file, present, args, store,
+                               manifest)] += 1
+    finally:
+        if own:
+            if store is not None:
+                store.close()
+            manifest.close(compact=False)
+    return urls, totals
+
+
+def plan_downloads(args, store, manifest, totals):
+    """Reads the HARs and returns the Downloads that need the network.
+
+    Embedded bodies (with --use-embedded) are written out along the way, since
+    that only takes local I/O. Everything else is tallied in totals.
+    """
+    har_files = args.har_files
+    if len(har_files) > 1:
+        jobs = args.parse_jobs or min(len(har_files), os.cpu_count() or 1)
+        with multiprocessing.Manager() as manager, \
+                concurrent.futures.ProcessPoolExecutor(jobs) as executor:
+            claims = manager.dict()
+            results = list(
+                executor.map(scan_har, har_files, itertools.repeat(args),
+                             itertools.repeat(None), itertools.repeat(None),
+                             itertools.repeat(claims), itertools.count()))
+    else:
+        results = [scan_har(har_file, args, store, manifest)
+                   for har_file in har_files]
+
+    # Embedded bodies are all written by now, so the planner's directory
+    # listings include them.
+    planner = Planner(args)
+    downloads = []
+    for url in itertools.chain.from_iterable(urls for urls, _ in results):
+        dest_file = local_path(url, args.destination_dir, args)
+        try:
+            present = planner.add(dest_file)
+        except OSError as e:
+            print(f"{url}: FAILED: {e}")
+            totals['failed'] += 1
+            continue
+        if present is None:
+            totals['duplicate'] += 1
+        elif present and not args.refresh:
+            print(f"{url}: SKIPPING, {dest_file} already exists")
+            totals['existing'] += 1
+        else:
+            if args.dry_run:
+                print(f"{url} -> {dest_file}")
+            downloads.append(Download(url, dest_file, present))
+    for _, har_totals in results:
+        totals.update(har_totals)
+    return downloads
+
+
+def download_worker(scheduler, pool, store, manifest, stats, args, totals,
+                    lock):
+    while True:
+        next_task = scheduler.next()
+        if next_task is None:
+            return
+        netloc, task = next_task
+        start = time.monotonic()
+        error = None
+        try:
+            result = download(task, pool, store, manifest, stats)
+        except Exception as e:
+            print(f"    FAILED: {task.url}: {e}")
+            result = 'failed'
+            error = e.code if isinstance(e, HTTPError) else type(e).__name__
+        finally:
+            stats.request(netloc, time.monotonic() - start, error)
+            scheduler.done(netloc, cooldown(args))
+        with lock:
+            totals[result] += 1
 
 
 def main():
     parser = argparse.ArgumentParser()
-    parser.add_argument("har_file")
+    parser.add_argument("har_files",
+                        metavar="har_file",
+                        nargs='+',
+                        help="HAR files, or directories of them.")
     parser.add_argument("destination_dir")
     parser.add_argument(
         "--dry-run",
@@ -92,36 +1072,144 @@ def main():
         action='store_true')
     parser.add_argument(
         "--cooldown-seconds",
-        help="This is the minimum amount of time to wait between downloads. "
-        "We add up to 50%% of jitter to this.",
-        type=int,
+        help="This is the minimum amount of time to wait between downloads "
+        "from the same host. We add up to 50%% of jitter to this.",
+        type=float,
         default=2)
+    parser.add_argument(
+        "--max-concurrency",
+        help="Maximum number of downloads in flight at once. Each host still "
+        "only gets one request at a time.",
+        type=int,
+        default=8)
+    parser.add_argument("--timeout",
+                        help="Socket timeout for each connection, in seconds.",
+                        type=float,
+                        default=60)
+    parser.add_argument(
+        "--parse-jobs",
+        help="How many HAR files to parse at once, in separate processes. "
+        "Defaults to the number of CPUs.",
+        type=int)
     parser.add_argument("--url-pattern",
                         help="Only download URLs containing this substring.")
+    parser.add_argument(
+        "--use-embedded",
+        help="Write response bodies embedded in the HAR directly, instead of "
+        "downloading them. Entries without a body are still downloaded.",
+        action='store_true')
+    parser.add_argument(
+        "--offline",
+        help="Like --use-embedded, but skip entries without a body instead of "
+        "downloading them.",
+        action='store_true')
+    parser.add_argument(
+        "--blob-store",
+        help="Keep one copy of each distinct file in this content-addressed "
+        "store, and link to it from the destination dir.")
+    parser.add_argument(
+        "--blob-link",
+        help="How to link files in the destination dir to the blob store. "
+        "Falls back to copying if the filesystem can't do it.",
+        choices=['hardlink', 'reflink', 'copy'],
+        default='hardlink')
+    parser.add_argument(
+        "--refresh",
+        help="Revalidate files that already exist with a conditional request "
+        "(If-None-Match/If-Modified-Since), and re-download the ones that "
+        "changed.",
+        action='store_true')
+    parser.add_argument(
+        "--manifest",
+        help="Where to keep the manifest of downloaded files. Defaults to "
+        f"{_MANIFEST} in the destination dir.")
+    parser.add_argument(
+        "--progress-seconds",
+        help="How often to print a progress line while downloading. 0 turns "
+        "it off.",
+        type=float,
+        default=10)
+    parser.add_argument(
+        "--stats-json",
+        help="Write transfer statistics for the run to this file, as JSON.")
     args = parser.parse_args()
+    args.har_files = find_hars(args.har_files)
+    if not args.har_files:
+        parser.error("no HAR files found")
+    if args.parse_jobs is not None and args.parse_jobs < 1:
+        parser.error("--parse-jobs must be at least 1")
+    if args.offline:
+        args.use_embedded = True
 
     dry_run_str = "[DRY RUN] " if args.dry_run else ""
-    print(f"===== {dry_run_str}READING HAR FILE =====")
-    urls = read_har(args)
-
-    print(f"\n===== {dry_run_str}DOWNLOADING FILES =====")
-    downloaded, existing = 0, 0
+    print(f"===== {dry_run_str}READING HAR FILES =====")
+    pool = ConnectionPool(args.timeout)
+    store = None
+    if args.blob_store and not args.dry_run:
+        store = BlobStore(args.blob_store, args.blob_link)
+    manifest = Manifest(manifest_path(args), readonly=args.dry_run)
+    totals = collections.Counter()
+    stats = None
+    stop_progress = threading.Event()
     try:
-        for url in urls[5:]:
-            if download(url, args.destination_dir,
-                        args) and args.cooldown_seconds != 0:
-                downloaded += 1
-                time.sleep(args.cooldown_seconds +
-                           (0.5 * args.cooldown_seconds * random.random()))
-            else:
-                existing += 1
-    except Exception as e:
-        raise
+        downloads = plan_downloads(args, store, manifest, totals)
+        revalidate = sum(1 for task in downloads if task.present)
+        print(f"\n{dry_run_str}Plan: {len(downloads)} to fetch "
+              f"({revalidate} to revalidate) / {totals['existing']} present. "
+              f"{totals['extracted']} extracted from the HAR, "
+              f"{totals['duplicate']} duplicate URLs.")
+        if args.dry_run:
+            return 0
+
+        print("\n===== DOWNLOADING FILES =====")
+        stats = Stats(len(downloads))
+        scheduler = HostScheduler(stats)
+        lock = threading.Lock()
+        workers = [
+            threading.Thread(target=download_worker,
+                             args=(scheduler, pool, store, manifest, stats,
+                                   args, totals, lock),
+                             daemon=True)
+            for _ in range(max(1, min(args.max_concurrency, len(downloads))))
+        ]
+        if args.progress_seconds > 0:
+            threading.Thread(target=report_progress,
+                             args=(stats, args.progress_seconds,
+                                   stop_progress),
+                             daemon=True).start()
+        for worker in workers:
+            worker.start()
+        for task in downloads:
+            scheduler.add(urlparse(task.url).netloc, task)
+        scheduler.close()
+        for worker in workers:
+            worker.join()
     finally:
+        stop_progress.set()
+        pool.close()
+        if store is not None:
+            store.close()
+        manifest.close()
+        if stats is not None:
+            summary = stats.summary()
+            print(f"Transferred {summary['bytes'] / 2**20:.1f} MiB in "
+                  f"{summary['elapsed_seconds']:.1f}s "
+                  f"({summary['bytes_per_second'] / 2**20:.2f} MiB/s). "
+                  f"Workers spent {summary['transfer_seconds']:.1f}s in "
+                  f"requests and {summary['cooldown_seconds']:.1f}s waiting "
+                  "for cooldowns.")
+            if args.stats_json:
+                with open(args.stats_json, 'w') as fh:
+                    json.dump(summary, fh, indent=2)
         print(
-            f"{dry_run_str}Downloaded {downloaded}, {existing} files already existed."
-        )
+            f"{dry_run_str}Downloaded {totals['downloaded']}, "
+            f"extracted {totals['extracted']} from the HAR, "
+            f"{totals['existing']} files already existed, "
+            f"{totals['unchanged']} were unchanged, "
+            f"{totals['unavailable']} had no embedded body, "
+            f"{totals['failed']} failed.")
+    return 1 if totals['failed'] else 0
 
 
 if __name__ == '__main__':
-    main()
+    sys.exit(main())
@@ -6,11 +6,28 @@
 # Sun Feb  7 13:38:06 EST 2010
 # Updated Sat Nov  2 22:00:17 EDT 2019
 # -----------------------------------------------------------------
+#
+# Give directories to edit those instead, and -r to edit everything under
+# them. Names are then paths relative to the current directory, and editing
+# the directory part moves a file (creating directories as needed).
+#
+# Changes are recorded in a journal (.mved-journal) before they are made.
+# If mved.py is interrupted, run it again with --resume to finish, or with
+# --undo to put everything back. --undo also works after a run that
+# finished, except for deletions, unless they went to a --trash directory.
 
 import sys
 import os
 import tempfile
 import argparse
+import concurrent.futures
+import json
+import threading
+import time
+
+JOURNAL = '.mved-journal'
+# Prefix of the temporary names files are parked under to break cycles.
+PARKING_PREFIX = '.mved-'
 
 
 def sorted_file_list(directory, all=False):
@@ -19,36 +36,507 @@ def sorted_file_list(directory, all=False):
     Args:
       all: if true, include hidden (dot) files.
     '''
-    files = os.listdir(directory)
-    if not all:
-        files = [f for f in files if not f.startswith('.')]
+    with os.scandir(directory) as it:
+        files = [e.name for e in it if all or not e.name.startswith('.')]
     files.sort()
     return files
 
 
+def file_list(directories, all=False, recursive=False):
+    '''Get a sorted list of the files in the given directories, as paths
+    relative to the current directory.
+
+    Args:
+      all: if true, include hidden (dot) files, and look in hidden
+        directories.
+      recursive: if true, list the files under each directory (but not
+        the directories themselves), however deep.
+    '''
+    files = set()
+    for directory in directories:
+        directory = os.path.normpath(directory)
+        prefix = '' if directory == '.' else directory
+        if not recursive:
+            files.update(os.path.join(prefix, f)
+                         for f in sorted_file_list(directory, all))
+            continue
+        stack = [prefix]
+        while stack:
+            d = stack.pop()
+            with os.scandir(d or '.') as it:
+                for e in it:
+                    if not all and e.name.startswith('.'):
+                        continue
+                    path = os.path.join(d, e.name)
+                    if e.is_dir(follow_symlinks=False):
+                        stack.append(path)
+                    else:
+                        files.add(path)
+    return sorted(files)
+
+
 def get_editor():
     '''Try to determine the user's preferred editor'''
     return os.getenv('EDITOR', os.getenv('VISUAL', 'vi'))
 
 
-def update_files(old_files, new_files, dry_run=True):
-    renames, deletes = 0, 0
-    for i, new_file in enumerate(new_files):
-        old_file = old_files[i]
-        if old_files[i] != new_file:
-            if new_file != '':
-                renames += 1
-                if dry_run:
-                    print('  mv %s %s' % (old_file, new_file))
-                else:
-                    os.rename(old_file, new_file)
+def temp_name(name, taken):
+    '''Returns a name in name's directory, not in taken, to park name under
+    during a cycle.'''
+    directory, base = os.path.split(name)
+    i = 0
+    while True:
+        tmp = os.path.join(directory, '%s%d-%d-%s' % (PARKING_PREFIX,
+                                                      os.getpid(), i, base))
+        if tmp not in taken:
+            return tmp
+        i += 1
+
+
+def trash_name(trash, name):
+    '''Where name goes in the trash directory for this run.
+
+    Files from each directory go in a directory of their own (named after
+    the directory, with slashes escaped), so that, like other changes,
+    deletes in different directories don't depend on each other.
+    '''
+    directory, base = os.path.split(name)
+    quoted = directory.replace('%', '%25').replace('/', '%2F') or '%2E'
+    return os.path.join(trash, quoted, base)
+
+
+def ancestors(path):
+    '''Yields the directories path is in, innermost first, short of the
+    current directory (for a relative path) or / (for an absolute one).'''
+    d = os.path.dirname(path)
+    while d and os.path.dirname(d) != d:
+        yield d
+        d = os.path.dirname(d)
+
+
+def plan_renames(old_files, new_files, exists=os.path.lexists,
+                 isdir=os.path.isdir, trash=None):
+    '''Work out the operations that turn old_files into new_files.
+
+    old_files[i] is renamed to new_files[i], or deleted if new_files[i] is
+    empty. Renames are ordered so that no file is overwritten before it has
+    been moved out of the way: in a chain (a->b, b->c) b moves first, and a
+    cycle (a->b, b->a) is broken by parking one file under a temporary name.
+
+    Returns (ops, renames, deletes), where ops is a list of ('mkdir', dir),
+    ('mv', src, dst) and ('rm', name) tuples to apply in order: first any
+    directories that renames need, then the rest. Raises ValueError if two
+    files would get the same name, a rename would overwrite a file that is
+    not itself being renamed or deleted, or a directory that is renamed or
+    deleted has something under it that is also changed (or moved into it):
+    the other change would then need the directory's old name or its new
+    one, depending on which went first.
+
+    Args:
+      exists: checks whether a name not in old_files is taken.
+      isdir: checks whether a directory exists.
+      trash: if given, a directory (which must not exist yet) to move
+        deleted files into instead of unlinking them.
+    '''
+    moves = {}
+    deletes = []
+    for old_file, new_file in zip(old_files, new_files):
+        if new_file != '':
+            new_file = os.path.normpath(new_file)
+        if new_file == old_file:
+            continue
+        if new_file == '':
+            deletes.append(old_file)
+        else:
+            moves[old_file] = new_file
+
+    # Each file has at most one new name and, once we have checked for
+    # clashes, each new name at most one old file, so the renames form
+    # simple chains and cycles.
+    by_dst = {}
+    listed = set(old_files)
+    for src, dst in moves.items():
+        if dst in by_dst:
+            raise ValueError('both %s and %s would be renamed to %s' % (
+                by_dst[dst], src, dst))
+        by_dst[dst] = src
+        if dst in listed:
+            if dst not in moves and dst not in deletes:
+                raise ValueError('%s would overwrite %s' % (src, dst))
+        elif exists(dst):
+            raise ValueError('%s would overwrite %s, which is not listed' % (
+                src, dst))
+
+    trashed = []
+    if trash is not None:
+        trashed = [('mv', f, trash_name(trash, f)) for f in deletes]
+    changed = set(moves) | set(by_dst) | set(deletes)
+    changed.update(op[2] for op in trashed)
+    for path in changed:
+        for d in ancestors(path):
+            if d in changed:
+                raise ValueError(
+                    '%s is renamed or deleted, and so is %s inside it; '
+                    'do one of them in a separate run' % (d, path))
+    # Directories are created one level at a time, so that --undo can
+    # remove exactly the ones we created.
+    mkdirs = set()
+    for op in trashed:
+        d = os.path.dirname(op[2])
+        while d and d not in mkdirs and not isdir(d):
+            mkdirs.add(d)
+            d = os.path.dirname(d)
+    for dst in by_dst:
+        d = os.path.dirname(dst)
+        while d and d not in mkdirs and not isdir(d):
+            mkdirs.add(d)
+            d = os.path.dirname(d)
+    ops = [('mkdir', d) for d in sorted(mkdirs)]
+    # Deleting first frees up those names for renames.
+    if trash is not None:
+        ops.extend(trashed)
+    else:
+        ops.extend(('rm', f) for f in deletes)
+    pending = dict(moves)
+
+    def unwind(name):
+        # name is now free: move whatever was going there, then whatever
+        # was going where that was, and so on back along the chain.
+        src = by_dst.get(name)
+        while src in pending:
+            ops.append(('mv', src, pending.pop(src)))
+            src = by_dst.get(src)
+
+    for src, dst in moves.items():
+        if src in pending and dst not in pending:
+            # The end of a chain: dst is (or will be) free.
+            ops.append(('mv', src, pending.pop(src)))
+            unwind(src)
+    # Whatever is left is in cycles.
+    taken = listed | set(by_dst)
+    while pending:
+        src, dst = next(iter(pending.items()))
+        del pending[src]
+        tmp = temp_name(src, taken)
+        taken.add(tmp)
+        ops.append(('mv', src, tmp))
+        unwind(src)
+        ops.append(('mv', tmp, dst))
+    return ops, len(moves), len(deletes)
+
+
+def independent_batches(ops):
+    '''Split ops, (index, op) pairs, into batches that touch disjoint sets of
+    directories, each in the original order, so that batches can be applied
+    concurrently.
+
+    An op that renames or removes a directory touches everything under it
+    too, so it goes in the same batch as any op on a path inside it.
+    '''
+    parent = {}
+
+    def find(d):
+        root = d
+        while parent.setdefault(root, root) != root:
+            root = parent[root]
+        while parent[d] != root:
+            parent[d], d = root, parent[d]
+        return root
+
+    changed = set(path for _, op in ops for path in op[1:])
+    for _, op in ops:
+        dirs = [find(os.path.dirname(path)) for path in op[1:]]
+        for path in op[1:]:
+            for d in ancestors(path):
+                if d in changed:
+                    dirs.append(find(os.path.dirname(d)))
+        for d in dirs[1:]:
+            parent[find(d)] = find(dirs[0])
+    batches = {}
+    for i, op in ops:
+        batches.setdefault(find(os.path.dirname(op[1])), []).append((i, op))
+    return list(batches.values())
+
+
+def apply_ops(ops, dir_fd, journal=None, stop=None):
+    '''Apply ops, (index, op) pairs, in order, stopping at the first that
+    fails (or when stop is set), and record each in journal.
+
+    Returns an error message, or None.
+    '''
+    for i, op in ops:
+        if stop is not None and stop.is_set():
+            return None
+        try:
+            if op[0] == 'mkdir':
+                os.mkdir(op[1], dir_fd=dir_fd)
+            elif op[0] == 'rmdir':
+                os.rmdir(op[1], dir_fd=dir_fd)
+            elif op[0] == 'mv':
+                os.rename(op[1], op[2], src_dir_fd=dir_fd, dst_dir_fd=dir_fd)
             else:
-                deletes += 1
-                if dry_run:
-                    print('  rm %s' % old_file)
+                os.unlink(op[1], dir_fd=dir_fd)
+        except OSError as e:
+            return '%s: %s' % (' '.join(op), e)
+        if journal is not None:
+            journal.done(i, op)
+    return None
+
+
+def update_files(ops, directory='.', dry_run=True, jobs=1, journal=None,
+                 skip=()):
+    '''Apply (or, if dry_run, print) ops from plan_renames().
+
+    Names are relative to directory, which we open once and use as the
+    dir_fd for every call instead of resolving its path again each time.
+    After creating (or before removing) directories, renames and deletes in
+    unrelated directories are applied on up to jobs threads, since on
+    network filesystems each call mostly waits on the server.
+
+    Args:
+      journal: a Journal to record each operation in as it is done.
+      skip: indices in ops of operations that are already done.
+
+    Returns a list of error messages; each means that the operations after
+    the failed one in the same directories were not applied.
+    '''
+    ops = [(i, op) for i, op in enumerate(ops) if i not in skip]
+    if dry_run:
+        for _, op in ops:
+            print('  %s' % ' '.join(op))
+        return []
+    mkdirs = [(i, op) for i, op in ops if op[0] == 'mkdir']
+    rmdirs = [(i, op) for i, op in ops if op[0] == 'rmdir']
+    batches = independent_batches(
+        [(i, op) for i, op in ops if op[0] not in ('mkdir', 'rmdir')])
+    dir_fd = os.open(directory, os.O_RDONLY | os.O_DIRECTORY)
+    try:
+        error = apply_ops(mkdirs, dir_fd, journal)
+        if error is not None:
+            return [error]
+        stop = threading.Event()
+        with concurrent.futures.ThreadPoolExecutor(jobs) as pool:
+            futures = [pool.submit(apply_ops, batch, dir_fd, journal, stop)
+                       for batch in batches]
+            try:
+                errors = [f.result() for f in futures]
+            except KeyboardInterrupt:
+                # Let the threads finish the operation they are on, so that
+                # the journal is up to date.
+                stop.set()
+                raise
+            errors = [e for e in errors if e is not None]
+        if errors:
+            return errors
+        error = apply_ops(rmdirs, dir_fd, journal)
+        return [error] if error is not None else []
+    finally:
+        os.close(dir_fd)
+
+
+def is_parking_name(name):
+    return os.path.basename(name).startswith(PARKING_PREFIX)
+
+
+class Journal(object):
+    '''An append-only record of a plan, and of which of its operations are
+    done.
+
+    Each line is a JSON value: a header with the directory the plan is
+    relative to and its sync_points(), then each operation, then the index
+    of each operation as it is done (in whatever order), then "finished".
+    The plan is synced to disk before any of it is applied. Progress is
+    synced every sync_every operations, and after each sync point, rather
+    than after each one; applied() works out the rest from the files
+    themselves.
+    '''
+    def __init__(self, path, sync_every=1000):
+        # --resume and --undo chdir to the directory the plan is relative to.
+        self.path = os.path.abspath(path)
+        self.sync_every = sync_every
+        self.fh = None
+        self.unsynced = 0
+        self.sync_after = set()
+        self.lock = threading.Lock()
+
+    def create(self, directory, ops, sync=()):
+        '''Write a new journal for ops, replacing any old one.'''
+        self.sync_after = set(sync)
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as fh:
+            fh.write(json.dumps({'directory': directory,
+                                 'sync': sorted(self.sync_after)}) + '\n')
+            fh.writelines(json.dumps(op) + '\n' for op in ops)
+            fh.flush()
+            os.fsync(fh.fileno())
+        os.rename(tmp, self.path)
+        dir_fd = os.open(os.path.dirname(os.path.abspath(self.path)),
+                         os.O_RDONLY | os.O_DIRECTORY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+        self.fh = open(self.path, 'a')
+
+    def reopen(self):
+        '''Carry on recording progress in an existing journal.'''
+        self.fh = open(self.path, 'a')
+
+    def read(self):
+        '''Returns (directory, ops, indices of ops done, finished), and
+        picks up the sync points, for reopen().'''
+        directory, ops, done, finished = None, [], set(), False
+        with open(self.path) as fh:
+            for line in fh:
+                try:
+                    value = json.loads(line)
+                except ValueError:
+                    # A partly written last line, after a crash.
+                    break
+                if isinstance(value, dict):
+                    directory = value['directory']
+                    self.sync_after = set(value.get('sync', ()))
+                elif isinstance(value, list):
+                    ops.append(tuple(value))
+                elif isinstance(value, int):
+                    done.add(value)
+                elif value == 'finished':
+                    finished = True
+        return directory, ops, done, finished
+
+    def done(self, i, op):
+        with self.lock:
+            self.fh.write('%d\n' % i)
+            self.unsynced += 1
+            if self.unsynced >= self.sync_every or i in self.sync_after:
+                self.sync()
+
+    def record(self, indices):
+        '''Record ops found to be done (by applied()) as done, so that from
+        now on only the ops this run applies are missing markers.'''
+        with self.lock:
+            self.fh.writelines('%d\n' % i for i in sorted(indices))
+            self.sync()
+
+    def sync(self):
+        self.fh.flush()
+        os.fsync(self.fh.fileno())
+        self.unsynced = 0
+
+    def finish(self):
+        self.fh.write(json.dumps('finished') + '\n')
+        self.sync()
+        self.fh.close()
+        self.fh = None
+
+
+def sync_points(ops, trash=None):
+    '''Indices of the ops whose done markers must be on disk before anything
+    after them runs, because the files alone can't show that they were done:
+    parking a file (a cycle that has finished looks just like one that hasn't
+    started), and deleting a name that a later rename reuses.'''
+    filled = {}
+    for i, op in enumerate(ops):
+        if op[0] == 'mv':
+            filled[op[2]] = i
+    points = set()
+    for i, op in enumerate(ops):
+        if op[0] == 'mv' and is_parking_name(op[2]):
+            points.add(i)
+        elif (op[0] == 'rm' or op[0] == 'mv' and trash is not None and
+              op[2].startswith(trash + os.sep)):
+            if filled.get(op[1], -1) > i:
+                points.add(i)
+    return points
+
+
+def applied(ops, done, sync=(), exists=os.path.lexists, isdir=os.path.isdir):
+    '''Returns the indices of ops that have been applied.
+
+    done holds those the journal says are done, and sync the sync_points().
+    Any others that were applied since the journal was last synced are
+    worked out from the files. Within each of independent_batches() of the
+    ops not yet done, ops are applied in order, so what was applied is a
+    prefix of the batch: we look for the one prefix that leaves each name
+    the batch touches existing (or not) as it does now. A prefix can't go
+    past an op in sync, since its marker would have been on disk before
+    the next op ran. Raises ValueError if we can't tell.
+    '''
+    done = set(done)
+    rest = []
+    for i, op in enumerate(ops):
+        if i in done:
+            continue
+        if op[0] == 'mkdir':
+            if isdir(op[1]):
+                done.add(i)
+        elif op[0] == 'rmdir':
+            if not exists(op[1]):
+                done.add(i)
+        else:
+            rest.append((i, op))
+
+    # Before the plan, each name that is moved or deleted existed (except
+    # those that were filled first), and other names didn't.
+    state = {}
+    for op in ops:
+        if op[0] in ('mv', 'rm'):
+            state.setdefault(op[1], True)
+        if op[0] == 'mv':
+            state.setdefault(op[2], False)
+
+    def apply(op):
+        state[op[1]] = False
+        if op[0] == 'mv':
+            state[op[2]] = True
+
+    for i, op in enumerate(ops):
+        if i in done and op[0] in ('mv', 'rm'):
+            apply(op)
+    for batch in independent_batches(rest):
+        names = set(name for _, op in batch for name in op[1:])
+        actual = dict((name, exists(name)) for name in names)
+        wrong = set(name for name in names if state[name] != actual[name])
+        limit = len(batch)
+        for n, (i, op) in enumerate(batch):
+            if i in sync:
+                limit = n + 1
+                break
+        candidates = [] if wrong else [0]
+        for n, (i, op) in enumerate(batch[:limit], 1):
+            apply(op)
+            for name in op[1:]:
+                if state[name] == actual[name]:
+                    wrong.discard(name)
                 else:
-                    os.unlink(old_file)
-    return renames, deletes
+                    wrong.add(name)
+            if not wrong:
+                candidates.append(n)
+        if len(candidates) != 1:
+            raise ValueError("can't tell how many of the changes from %s on "
+                             'were done' % ' '.join(batch[0][1]))
+        done.update(i for i, _ in batch[:candidates[0]])
+    return done
+
+
+def invert(ops, done):
+    '''Returns the operations that undo the done ones in ops, and how many
+    deletions can't be undone.'''
+    inverse = []
+    lost = 0
+    for i in reversed(range(len(ops))):
+        if i not in done:
+            continue
+        op = ops[i]
+        if op[0] == 'mv':
+            inverse.append(('mv', op[2], op[1]))
+        elif op[0] == 'mkdir':
+            inverse.append(('rmdir', op[1]))
+        elif op[0] == 'rmdir':
+            inverse.append(('mkdir', op[1]))
+        else:
+            lost += 1
+    return inverse, lost
 
 
 def confirm(msg, default=False):
@@ -67,16 +555,76 @@ def main(argv):
         action='store_true',
         dest='list_all',
         help='List all files (including dotfiles; excluding "." and "..").')
+    parser.add_argument(
+        '-r',
+        '--recursive',
+        default=False,
+        action='store_true',
+        help='List every file under the directories, rather than just the '
+        'entries in them.')
+    parser.add_argument(
+        '-j',
+        '--jobs',
+        type=int,
+        default=8,
+        help='How many directories to apply changes in at once.')
+    parser.add_argument(
+        '--trash',
+        default=None,
+        help='Move deleted files into a new directory under this one '
+        '(which must be on the same filesystem) instead of deleting them, '
+        'so that --undo can bring them back.')
+    parser.add_argument(
+        '--journal',
+        default=JOURNAL,
+        help='Where to record changes (default: %(default)s).')
+    parser.add_argument(
+        '--fsync-every',
+        type=int,
+        default=1000,
+        help='Sync the journal to disk after this many changes.')
+    parser.add_argument(
+        '--resume',
+        default=False,
+        action='store_true',
+        help='Finish the changes in the journal, after an interruption.')
+    parser.add_argument(
+        '--undo',
+        default=False,
+        action='store_true',
+        help='Undo the changes in the journal that were made.')
+    parser.add_argument(
+        'directories',
+        nargs='*',
+        default=['.'],
+        help='Directories to edit (default: the current directory).')
     args = parser.parse_args()
 
+    journal = Journal(args.journal, args.fsync_every)
+    if args.resume or args.undo:
+        replay(journal, args)
+        return
+    if os.path.exists(args.journal) and not journal.read()[3]:
+        print('ERROR: %s records changes that were not finished. Use '
+              '--resume or --undo (or remove it).' % args.journal)
+        sys.exit(2)
+
     cwd = os.getcwd()
-    files = sorted_file_list(cwd, args.list_all)
+    files = file_list(args.directories, args.list_all, args.recursive)
+    ours = set(os.path.normpath(os.path.relpath(p)) for p in (
+        args.journal, args.journal + '.tmp'))
+    files = [f for f in files if f not in ours]
     editor = get_editor()
+    for f in files:
+        if '\n' in f:
+            print("ERROR: %r has a newline in its name, which we can't edit "
+                  'as a line.' % f)
+            sys.exit(2)
 
     tmpfd, tmpname = tempfile.mkstemp()
-    for f in files:
-        os.write(tmpfd, bytes(f + '\n', encoding='utf-8'))
-    os.close(tmpfd)
+    with os.fdopen(tmpfd, 'wb') as tmp:
+        # fsencode() round-trips names that aren't valid UTF-8.
+        tmp.writelines(os.fsencode(f) + b'\n' for f in files)
 
     pid = os.fork()
     if pid == 0:
@@ -93,7 +641,7 @@ def main(argv):
                                                                  w_status))
         sys.exit(2)
 
-    with open(tmpname, 'r') as tmp:
+    with open(tmpname, 'rb') as tmp:
         new_files = tmp.readlines()
         if len(new_files) != len(files):
             print(
@@ -101,21 +649,103 @@ def main(argv):
                 'lines to delete files.')
             sys.exit(2)
     os.unlink(tmpname)
-    new_files = [f.rstrip('\n\r') for f in new_files]
+    new_files = [os.fsdecode(f.rstrip(b'\n\r')) for f in new_files]
 
-    renames, deletes = update_files(files, new_files, dry_run=True)
+    trash = None
+    if args.trash is not None:
+        trash = os.path.join(args.trash, 'mved-%s-%d' % (
+            time.strftime('%Y%m%d-%H%M%S'), os.getpid()))
+    try:
+        ops, renames, deletes = plan_renames(files, new_files, trash=trash)
+    except ValueError as e:
+        print('ERROR: %s. Aborting.' % e)
+        sys.exit(2)
     if renames + deletes == 0:
         print('No changes.')
         sys.exit(0)
+    mkdirs = sum(1 for op in ops if op[0] == 'mkdir')
+    update_files(ops, cwd, dry_run=True)
     proceed = confirm(
-        'Will rename %d and delete %d files. Proceed? ' % (renames, deletes),
+        'Will %srename %d and delete %d files. Proceed? ' % (
+            'create %d directories, ' % mkdirs if mkdirs else '', renames,
+            deletes),
         default=False)
     if not proceed:
         print('No. Aborting.')
         sys.exit(1)
-    renames, deletes = update_files(files, new_files, dry_run=False)
+    journal.create(cwd, ops, sync_points(ops, trash))
+    apply_with_journal(ops, cwd, args, journal)
     print('Renamed %d and deleted %d files.' % (renames, deletes))
 
 
+def apply_with_journal(ops, directory, args, journal, skip=()):
+    '''Apply ops, recording them in journal, and exit if any fail.'''
+    try:
+        errors = update_files(ops, directory, dry_run=False, jobs=args.jobs,
+                              journal=journal, skip=skip)
+    except KeyboardInterrupt:
+        journal.sync()
+        print('Interrupted. Use --resume to finish, or --undo.')
+        sys.exit(1)
+    for error in errors:
+        print('ERROR: %s' % error)
+    if errors:
+        journal.sync()
+        print('Some changes were not made. Fix the problem and use '
+              '--resume, or use --undo.')
+        sys.exit(1)
+    journal.finish()
+
+
+def replay(journal, args):
+    '''Handle --resume and --undo.'''
+    if not os.path.exists(journal.path):
+        print('ERROR: No journal at %s.' % journal.path)
+        sys.exit(2)
+    directory, ops, marked, finished = journal.read()
+    os.chdir(directory)
+    try:
+        done = applied(ops, marked, journal.sync_after)
+    except ValueError as e:
+        print('ERROR: %s. Check %s by hand.' % (e, journal.path))
+        sys.exit(2)
+
+    if args.resume:
+        if finished or len(done) == len(ops):
+            if not finished:
+                journal.reopen()
+                journal.record(done - marked)
+                journal.finish()
+            print('Nothing to resume.')
+            return
+        update_files(ops, directory, dry_run=True, skip=done)
+        if not confirm('Will make the remaining %d of %d changes. Proceed? '
+                       % (len(ops) - len(done), len(ops))):
+            print('No. Aborting.')
+            sys.exit(1)
+        journal.reopen()
+        journal.record(done - marked)
+        apply_with_journal(ops, directory, args, journal, skip=done)
+        print('Done.')
+        return
+
+    inverse, lost = invert(ops, done)
+    if lost:
+        print("%d deleted files can't be brought back (use --trash next "
+              'time).' % lost)
+    if not inverse:
+        print('Nothing to undo.')
+        return
+    update_files(inverse, directory, dry_run=True)
+    if not confirm('Will undo %d changes. Proceed? ' % len(inverse)):
+        print('No. Aborting.')
+        sys.exit(1)
+    # The undo gets a journal of its own, so that it can be resumed, or
+    # undone in turn.
+    journal.create(directory, inverse, sync_points(inverse))
+    apply_with_journal(inverse, directory, args, journal)
+    print('Undid %d changes.' % len(inverse))
+
+
 if __name__ == '__main__':
     main(sys.argv)
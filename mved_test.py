@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+# Checks that mved.py can tell how far a plan got after a crash, at every
+# point where it could have crashed, and that it won't plan changes to a
+# directory and to what's inside it together. Run with: python3 mved_test.py
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import mved
+
+
+class CrashRecoveryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.dir = tempfile.mkdtemp(prefix='mved_test.')
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.dir)
+
+    def make_files(self, names):
+        work = tempfile.mkdtemp(dir=self.dir)
+        os.chdir(work)
+        for name in names:
+            if os.path.dirname(name):
+                os.makedirs(os.path.dirname(name), exist_ok=True)
+            with open(name, 'w') as fh:
+                fh.write(name)
+        return work
+
+    def contents(self):
+        found = {}
+        for root, _, files in os.walk('.'):
+            for f in files:
+                path = os.path.normpath(os.path.join(root, f))
+                with open(path) as fh:
+                    found[path] = fh.read()
+        return found
+
+    def crash_after(self, ops, crash, old):
+        '''Sets up old, and applies the first crash ops.'''
+        # An absolute trash directory is shared by every setup.
+        shutil.rmtree(os.path.join(self.dir, 'trash'), ignore_errors=True)
+        work = self.make_files(old)
+        dir_fd = os.open('.', os.O_RDONLY | os.O_DIRECTORY)
+        try:
+            self.assertIsNone(mved.apply_ops(list(enumerate(ops[:crash])),
+                                             dir_fd))
+        finally:
+            os.close(dir_fd)
+        return work
+
+    def check_every_crash(self, old, new, trash=None):
+        '''Crash after each op in turn, with only the markers up to the last
+        sync point on disk, and check that applied() finds exactly the ops
+        that ran, and that resuming or undoing from there works.'''
+        self.make_files(old)
+        before = self.contents()
+        ops, _, _ = mved.plan_renames(old, new, trash=trash)
+        sync = mved.sync_points(ops, trash)
+        self.crash_after(ops, len(ops), old)
+        final = self.contents()
+        for crash in range(len(ops) + 1):
+            synced = [i for i in sync if i < crash]
+            marked = set(range(max(synced) + 1)) if synced else set()
+
+            work = self.crash_after(ops, crash, old)
+            done = mved.applied(ops, marked, sync)
+            self.assertEqual(done, set(range(crash)),
+                             'crash after %d of %s' % (crash, ops))
+            self.assertEqual(
+                mved.update_files(ops, work, dry_run=False, skip=done), [])
+            self.assertEqual(self.contents(), final)
+
+            work = self.crash_after(ops, crash, old)
+            inverse, lost = mved.invert(ops, mved.applied(ops, marked, sync))
+            self.assertEqual(mved.update_files(inverse, work, dry_run=False),
+                             [])
+            expected = dict(before)
+            for op in ops[:crash]:
+                if op[0] == 'rm':
+                    del expected[op[1]]
+            self.assertEqual(self.contents(), expected)
+
+    def test_delete_then_reuse(self):
+        self.check_every_crash(['f', 'g'], ['', 'f'])
+
+    def test_delete_to_trash_then_reuse(self):
+        self.check_every_crash(['f', 'g'], ['', 'f'], trash='trash/run')
+
+    def test_delete_to_absolute_trash_then_reuse(self):
+        self.check_every_crash(['f', 'g'], ['', 'f'],
+                               trash=os.path.join(self.dir, 'trash', 'run'))
+
+    def test_chain(self):
+        self.check_every_crash(['c', 'd'], ['d', 'e'])
+
+    def test_cycle(self):
+        self.check_every_crash(['a', 'b'], ['b', 'a'])
+
+    def test_rotation(self):
+        names = ['f%d' % i for i in range(6)]
+        self.check_every_crash(names, names[1:] + names[:1])
+
+    def test_across_directories(self):
+        self.check_every_crash(['x', 'sub/y', 'sub/w'],
+                               ['sub/z/x', 'y', ''])
+
+
+class NestedChangesTest(unittest.TestCase):
+
+    def check_rejected(self, old, new, trash=None):
+        with self.assertRaises(ValueError):
+            mved.plan_renames(old, new, exists=lambda _: False,
+                              isdir=lambda _: True, trash=trash)
+
+    def test_move_into_renamed_directory(self):
+        self.check_rejected(['a', 'x'], ['b', 'a/x'])
+
+    def test_rename_inside_renamed_directory(self):
+        self.check_rejected(['sub', 'sub/f1'], ['sub2', 'sub/g1'])
+
+    def test_rename_inside_deleted_directory(self):
+        self.check_rejected(['sub', 'sub/f1'], ['', 'sub/g1'])
+
+    def test_trash_inside_deleted_directory(self):
+        self.check_rejected(['sub', 'x'], ['', ''], trash='sub/trash')
+
+    def test_absolute_trash(self):
+        ops, _, _ = mved.plan_renames(
+            ['a', 'b', 'c', 'd/e'], ['b', 'a', '', 'e'],
+            exists=lambda _: False, isdir=lambda d: d in ('/', '/tmp'),
+            trash='/tmp/mvtrash/run')
+        self.assertIn(('mv', 'c', '/tmp/mvtrash/run/%2E/c'), ops)
+        self.assertEqual(
+            sum(len(b) for b in mved.independent_batches(
+                [(i, op) for i, op in enumerate(ops) if op[0] == 'mv'])),
+            sum(1 for op in ops if op[0] == 'mv'))
+
+    def test_absolute_trash_inside_deleted_directory(self):
+        self.check_rejected(['/tmp/sub', 'x'], ['', ''],
+                            trash='/tmp/sub/trash')
+
+    def test_batches_follow_ancestry(self):
+        ops = list(enumerate([('mv', 'p/a', 'p/b'), ('mv', 'q/a', 'q/b'),
+                              ('mv', 'p/d', 'p/e'), ('mv', 'p/d/c/x', 'y')]))
+        batches = mved.independent_batches(ops)
+        self.assertEqual(sorted([i for i, _ in b] for b in batches),
+                         [[0, 2, 3], [1]])
+
+
+if __name__ == '__main__':
+    unittest.main()
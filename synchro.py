@@ -1,4 +1,4 @@
-#!/usr/bin/python
+#!/usr/bin/env python3
 
 # This script manages a subprocess and provides mechanisms for synchronization
 # and setting timeouts. It is designed to make it easier to manage cron jobs
@@ -6,7 +6,8 @@
 #
 # Specifically, it provides machanisms to do the following:
 # - run a subprocess
-# - if that subprocess takes too long to exit, kill it
+# - if that subprocess takes too long to exit, kill it (and everything it
+#   started)
 # - if that subprocess is already running (via this wrapper), abort.
 #
 # Example usage:
@@ -17,153 +18,1300 @@
 #   $ synchro.py --synchronous_name longproc --timeout=5 -- long_proc -x -y
 # Run long_proc with a 5s timeout; if one is currently running, exit successfully:
 #   $ synchro.py --synchronous_name longproc --nonblocking --timeout=5 -- long_proc -x -y
+# Run long_proc, allowing up to 3 to run at once; further invocations wait
+# their turn, first come first served:
+#   $ synchro.py --synchronous_name longproc --slots 3 -- long_proc -x -y
+# Run each command in commands.txt (one per line, quoted as for the shell),
+# 3 at a time, each with a 5s timeout:
+#   $ synchro.py --synchronous_name batch --slots 3 --timeout=5 \
+#       --argv_file commands.txt
+# Run long_proc from the same crontab on many hosts, but spread the starts
+# over 10 minutes (each host always gets the same delay), and only when the
+# host is already busy:
+#   $ synchro.py --synchronous_name longproc --splay 600 --splay_if_load 1 \
+#       -- long_proc -x -y
+# Run long_proc with a 1h timeout, but kill it sooner if it goes 5 minutes
+# without printing anything, and keep the last 64KB of its output:
+#   $ synchro.py --timeout=3600 --idle_timeout=300 --save_output=64 \
+#       -- long_proc -x -y
+# Run long_proc in its own cgroup (v2), with all long_procs together limited
+# to 2 CPUs and 4GB of memory:
+#   $ synchro.py --synchronous_name longproc --cgroup /sys/fs/cgroup/synchro \
+#       --cpu_max 2 --memory_max 4G -- long_proc -x -y
+#
+# On hosts that run many wrapped jobs, a long-lived supervisor can own the
+# locks, timeouts and child processes instead, so that each invocation is
+# just a thin client that hands its job (and its stdin/stdout/stderr) to the
+# supervisor over a Unix socket and waits for the exit code:
+#   $ synchro.py --serve --socket ~/.cache/synchro.py/supervisor.sock &
+#   $ synchro.py --socket ~/.cache/synchro.py/supervisor.sock \
+#       --synchronous_name longproc --timeout=5 -- long_proc -x -y
+# If no supervisor is listening, the client runs the job itself.
+#
+# Every run is recorded (duration, time spent waiting for the lock, exit code,
+# and the child's CPU time, peak memory, block I/O and context switches) in
+# history.db in --synchronization_dir. With --cgroup, peak memory is the
+# cgroup's memory.peak, if the kernel has it; otherwise it is the child's peak
+# RSS, which the kernel counts from before the child exec()s, so it includes
+# up to synchro.py's own. To see how each job has been doing:
+#   $ synchro.py --report
+# (With --synchronous_name, this also shows the saved output of the last
+# failed run.)
+
+import json
+import os
+import socket
+import sys
+
+# Upper bound on the size of a request or reply on the supervisor socket.
+MAX_MESSAGE = 1 << 20
+
+
+def socket_arg(argv):
+    """Returns the --socket in our command line argv, or None if there is
+    none, or if argv is for --serve.
+
+    This only knows the plain spellings of the flags, which is all the quick
+    path for clients below needs: anything else goes through the full parser.
+    """
+    path = None
+    for i, arg in enumerate(argv):
+        if arg == '--':
+            break
+        if arg == '--serve':
+            return None
+        if arg == '--socket' and i + 1 < len(argv):
+            path = argv[i + 1]
+        elif arg.startswith('--socket='):
+            path = arg[len('--socket='):]
+    return path
+
+
+def submit(path, argv):
+    """Hands the job described by our command line argv to the supervisor
+    listening on path.
+
+    Returns (exit code to exit with, None), or (None, why) if no supervisor
+    is listening, or it cannot run the job (in which case it has not
+    started it).
+    """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+    try:
+        sock.connect(path)
+    except (FileNotFoundError, ConnectionRefusedError) as e:
+        sock.close()
+        return None, 'no supervisor listening: %s' % e
+    request = {
+        'argv': argv,
+        'cwd': os.getcwd(),
+        'env': dict(os.environ),
+    }
+    socket.send_fds(sock, [json.dumps(request).encode()], [0, 1, 2])
+    reply = sock.recv(MAX_MESSAGE)
+    sock.close()
+    if not reply:
+        sys.stderr.write('synchro.py: the supervisor on %s hung up without '
+                'a reply\n' % path)
+        return 3, None
+    returncode = json.loads(reply)['returncode']
+    if returncode is None:
+        return None, 'the supervisor cannot run this command line'
+    return returncode, None
+
+
+# With --socket, we are usually just a client of the supervisor, and the
+# imports (asyncio above all) and parser we need to run a job ourselves take
+# several times as long as handing it over does. So try that first, with the
+# bare command line, which the supervisor parses for us.
+supervisor_socket = socket_arg(sys.argv[1:])
+no_supervisor = None
+if supervisor_socket is not None:
+    returncode, no_supervisor = submit(supervisor_socket, sys.argv[1:])
+    if returncode is not None:
+        sys.exit(returncode)
 
 import argparse
+import asyncio
+import contextlib
 import datetime
 import fcntl
-import os
+import hashlib
+import io
+import itertools
+import resource
+import select
+import shlex
+import signal
+import sqlite3
 import subprocess
-import sys
 import syslog
-import threading
+import time
 
 
 parser = argparse.ArgumentParser(
         description='Run a subprocess with timeouts and synchronization.')
-parser.add_argument('--synchronous_name', '-n', default=None, 
+parser.add_argument('--synchronous_name', '-n', default=None,
         help='Unique name, for synchronization. We will not start the '
         'subprocess if another synchro script is still running with this '
         'name.')
 parser.add_argument('--timeout', '-t', type=float, default=None,
         help='timeout, in seconds. If subprocess takes longer than this, '
         'we send it a SIGTERM, then a SIGKILL (signal 9).')
+parser.add_argument('--idle_timeout', type=float, default=None,
+        help='If the subprocess goes this many seconds without writing '
+        'anything to stdout or stderr, kill it as if it had timed out.')
+parser.add_argument('--save_output', type=int, default=0, metavar='KB',
+        help='Save the last KB kilobytes of the output of the subprocess '
+        '(stdout and stderr together) with the run in --history.')
+parser.add_argument('--splay', type=float, default=None, metavar='SECONDS',
+        help='Delay the start by up to this long, by an amount that depends '
+        'only on the hostname and --synchronous_name, so that hosts running '
+        'the same job at the same time spread out. This comes before waiting '
+        'for the lock, and does not count against --timeout.')
+parser.add_argument('--splay_if_load', type=float, default=None,
+        help='Only --splay if the 1-minute load average per CPU is above '
+        'this.')
+parser.add_argument('--splay_if_pressure', type=float, default=None,
+        metavar='PERCENT',
+        help='Only --splay if the CPU, I/O or memory pressure (the Linux '
+        'PSI "some" average over the last 10s) is above this percentage.')
 parser.add_argument('--nonblocking', default=False, action='store_true',
         help='If --synchronous_name is specified, and another process '
         'holds the file lock, exit successfully instead of waiting for lock.')
-parser.add_argument('--synchronization_dir',
-        default=os.getenv('HOME') + '/.cache/synchro.py',
+parser.add_argument('--slots', type=int, default=1,
+        help='With --synchronous_name, how many invocations with that name '
+        'may run at once. Further invocations wait in the order they '
+        'arrived. All invocations with the same name should agree on this.')
+parser.add_argument('--synchronization_dir', default=None,
         help='Where to put synchronization files when using '
-        '--synchronous_name')
+        '--synchronous_name (default: ~/.cache/synchro.py)')
 parser.add_argument('--verbose', '-v', default=False, action='store_true',
         help='Print verbose log messages to stderr.')
 parser.add_argument('--syslog', default=False, action='store_true',
         help='If --verbose, log to syslog instead of stderr.')
 parser.add_argument('--kill_timeout', type=float, default=1.0,
         help='How long to wait after SIGTERM before sending SIGKILL.')
-parser.add_argument('subprocess',
+parser.add_argument('--cgroup', default=None,
+        help='Run each subprocess in a new cgroup (v2) under this directory, '
+        'which must be writable by us (e.g. a delegated systemd slice). '
+        'Without this, we can only clean up after subprocesses that stay in '
+        'their process group.')
+parser.add_argument('--cpu_max', type=float, default=None,
+        help='With --cgroup, how many CPUs all running subprocesses with '
+        'this --synchronous_name may use between them.')
+parser.add_argument('--memory_max', type=lambda s: parse_size(s),
+        default=None,
+        help='With --cgroup, how much memory all running subprocesses with '
+        'this --synchronous_name may use between them, in bytes, or with a '
+        'K, M or G suffix.')
+parser.add_argument('--history', default=None,
+        help='SQLite database to record runs in. Defaults to history.db in '
+        '--synchronization_dir.')
+parser.add_argument('--no_history', default=False, action='store_true',
+        help='Do not record this run in --history.')
+parser.add_argument('--report', default=False, action='store_true',
+        help='Instead of running a subprocess, print duration and resource '
+        'usage percentiles and trends per --synchronous_name from --history '
+        '(only for the given name, if there is one).')
+parser.add_argument('--report_runs', type=int, default=50,
+        help='With --report, how many recent runs of each name to consider.')
+parser.add_argument('--serve', default=False, action='store_true',
+        help='Run as a supervisor, accepting jobs from other synchro.py '
+        'invocations on --socket, instead of running a subprocess.')
+parser.add_argument('--socket', default=None,
+        help='Unix socket of a --serve supervisor. If given, hand the '
+        'subprocess to the supervisor to run (falling back to running it '
+        'ourselves if nothing is listening). With --serve, where to listen; '
+        'defaults to supervisor.sock in --synchronization_dir.')
+parser.add_argument('--argv_file', default=None,
+        help='Run each command in this file (one per line, quoted as for the '
+        'shell; blank lines and # comments are ignored) instead of '
+        'subprocess, all with the same options. With --synchronous_name, '
+        'each command takes its own slot, in the order listed. We exit with '
+        'the worst exit code of all the commands.')
+parser.add_argument('subprocess', nargs='?',
         help='Name of subprocess to be executed.')
 parser.add_argument('subprocess_args', nargs='*', default=[],
         help='Any arguments to subprocess to be executed. Note that you may '
         'need to use "--" before any flags.')
 
+# How often a waiter checks whether it is its turn for a slot.
+LOCK_POLL_INTERVAL = 0.1
+# How often we check whether a subprocess's descendants have exited after
+# SIGTERM.
+TREE_POLL_INTERVAL = 0.05
+# The cgroup cpu.max period, in microseconds.
+CPU_PERIOD = 100000
+# How much of the subprocess's output we read at a time.
+OUTPUT_CHUNK = 1 << 16
+# How much of the subprocess's output we hold on to for a reader that is not
+# keeping up, before we stop reading more.
+OUTPUT_BUFFER = 1 << 20
+# Why we killed a subprocess, as recorded in the history's timed_out.
+TIMEOUT = 1
+IDLE_TIMEOUT = 2
+
 
-class ProcessThread(threading.Thread):
-    """ProcessThread manages subprocess invocation.
+class Output(object):
+    """Copies a subprocess's stdout and stderr from pipes to where they would
+    otherwise have gone, keeping the last `keep` bytes of both together and
+    the time we last saw any.
 
-    When the subprocess ends, the thread exits. The thread provides mechanisms
-    to forcefully kill the subprocess.
+    The copying is done by event loop callbacks, from start() until
+    finish(). In between, where the output goes is non-blocking, and what it
+    will not take yet is buffered. Once OUTPUT_BUFFER bytes are waiting for
+    one place, we stop reading the pipes that go there until it catches up,
+    so a reader that stalls only holds up this subprocess (which blocks
+    writing to its pipe), not the event loop.
     """
-    def __init__(self, argv):
-        super(ProcessThread, self).__init__()
-        self.argv = argv
-        self.popen = None
+    # fd -> [Outputs using it, whether it was blocking before the first],
+    # since with --argv_file several jobs write to our own stdout at once.
+    nonblocking = {}
 
-    def run(self):
+    def __init__(self, keep, stdout, stderr):
+        self.keep = keep
+        self.tail = bytearray()
+        self.last = time.monotonic()
+        self.loop = None
+        # Our own copy of each fd the output goes to (so that the event loop
+        # can watch it, even if other jobs write to the same fd) -> that fd.
+        self.destinations = {}
+        # Read end -> (write end, where the output goes).
+        self.pipes = {}
+        # Where the output goes -> what is waiting to be written there, or
+        # None once writing there has failed.
+        self.pending = {}
+        self.paused = set()
+        copies = {}
+        for fd in (stdout, stderr):
+            if fd not in copies:
+                copies[fd] = os.dup(fd)
+                self.destinations[copies[fd]] = fd
+            r, w = os.pipe()
+            os.set_blocking(r, False)
+            self.pipes[r] = (w, copies[fd])
+            self.pending[copies[fd]] = bytearray()
+
+    def popen_args(self):
+        """Returns the subprocess.Popen() arguments for the child's end."""
+        stdout, stderr = [w for w, _ in self.pipes.values()]
+        return {'stdout': stdout, 'stderr': stderr}
+
+    def started(self):
+        """Closes our copies of the child's ends, once it has them."""
+        for r, (w, destination) in self.pipes.items():
+            if w is not None:
+                os.close(w)
+                self.pipes[r] = (None, destination)
+
+    def start(self, loop):
+        """Starts copying, in loop."""
+        self.loop = loop
+        for destination, fd in self.destinations.items():
+            users = Output.nonblocking.setdefault(fd,
+                    [0, os.get_blocking(fd)])
+            users[0] += 1
+            os.set_blocking(destination, False)
+        for fd in self.pipes:
+            loop.add_reader(fd, self.read, fd)
+
+    def read(self, fd):
+        """Event loop reader callback: copies what there is to read from
+        fd."""
+        try:
+            data = os.read(fd, OUTPUT_CHUNK)
+        except BlockingIOError:
+            return
+        if not data:
+            self.close(fd)
+            return
+        self.last = time.monotonic()
+        self.tail += data
+        if len(self.tail) > self.keep:
+            del self.tail[:len(self.tail) - self.keep]
+        destination = self.pipes[fd][1]
+        pending = self.pending[destination]
+        # If whoever was reading our output went away, keep reading anyway,
+        # or the subprocess will block writing to a full pipe.
+        if pending is not None:
+            flushed = not pending
+            pending += data
+            if flushed:
+                self.flush(destination)
+            elif len(pending) >= OUTPUT_BUFFER:
+                self.pause(destination, True)
+
+    def flush(self, destination):
+        """Writes what destination will take of what is waiting for it. Also
+        an event loop writer callback."""
+        pending = self.pending[destination]
+        try:
+            while pending:
+                del pending[:os.write(destination, pending)]
+        except BlockingIOError:
+            pass
+        except OSError:
+            self.pending[destination] = pending = None
+        if pending:
+            self.loop.add_writer(destination, self.flush, destination)
+        else:
+            self.loop.remove_writer(destination)
+        self.pause(destination,
+                pending is not None and len(pending) >= OUTPUT_BUFFER)
+
+    def pause(self, destination, paused):
+        """Stops (or resumes) reading the pipes that go to destination."""
+        if paused == (destination in self.paused):
+            return
+        for fd, (_, d) in self.pipes.items():
+            if d != destination:
+                continue
+            if paused:
+                self.loop.remove_reader(fd)
+            else:
+                self.loop.add_reader(fd, self.read, fd)
+        if paused:
+            self.paused.add(destination)
+        else:
+            self.paused.discard(destination)
+
+    async def finish(self):
+        """Copies whatever is left in the pipes without waiting for more,
+        closes them, and waits for it all to be written. (Anything the
+        subprocess left running may still have the pipes open.)"""
+        for fd in list(self.pipes):
+            self.loop.remove_reader(fd)
+            while fd in self.pipes and select.select([fd], [], [], 0)[0]:
+                self.read(fd)
+            if fd in self.pipes:
+                self.close(fd)
+        while any(self.pending.values()):
+            await asyncio.sleep(TREE_POLL_INTERVAL)
+        for destination, fd in self.destinations.items():
+            self.loop.remove_writer(destination)
+            users = Output.nonblocking[fd]
+            users[0] -= 1
+            if not users[0]:
+                del Output.nonblocking[fd]
+                os.set_blocking(destination, users[1])
+            os.close(destination)
+
+    def close(self, fd):
+        self.loop.remove_reader(fd)
+        os.close(fd)
+        del self.pipes[fd]
+
+
+class ProcessTree(object):
+    """A subprocess and everything it starts, to be signalled as a whole.
+
+    The subprocess runs in a new session, so by default the tree is its
+    process group. With opts.cgroup it also gets a cgroup of its own, at
+    <opts.cgroup>/<name>/<token>, which keeps track of descendants that
+    leave the process group too. --cpu_max and --memory_max are set on the
+    <name> cgroup, so they cap all concurrent runs with that name together.
+    We also turn on the memory controller for the run's cgroup, if we can,
+    for its memory.peak.
+    """
+    def __init__(self, opts, token):
+        self.pgid = None
+        self.cgroup = None
+        if opts.cgroup is None:
+            return
+        parent = os.path.join(opts.cgroup, job_name(opts))
+        # Other jobs with the same name may be creating it too.
+        os.makedirs(parent, exist_ok=True)
+        limits = {}
+        if opts.cpu_max is not None:
+            limits['cpu.max'] = '%d %d' % (opts.cpu_max * CPU_PERIOD,
+                    CPU_PERIOD)
+        if opts.memory_max is not None:
+            limits['memory.max'] = str(opts.memory_max)
+        for name, value in sorted(limits.items()):
+            controller = name.split('.')[0]
+            write_cgroup_file(os.path.join(opts.cgroup,
+                'cgroup.subtree_control'), '+%s' % controller)
+            write_cgroup_file(os.path.join(parent, name), value)
         try:
-            self.popen = subprocess.Popen(self.argv)
-            self.popen.wait()
+            for d in (opts.cgroup, parent):
+                write_cgroup_file(os.path.join(d, 'cgroup.subtree_control'),
+                        '+memory')
         except OSError as e:
-            print >>sys.stderr, e
+            log('No memory controller for %s: %s' % (parent, e))
+        self.cgroup = os.path.join(parent, token)
+        os.mkdir(self.cgroup)
 
-    def terminate(self):
-        if self.popen is not None:
-            log('Sending SIGTERM to child process %d' % self.popen.pid)
-            self.popen.terminate()
+    def __str__(self):
+        if self.cgroup is not None:
+            return 'cgroup %s' % self.cgroup
+        return 'process group'
 
-    def kill(self):
-        if self.popen is not None:
-            log('Sending SIGKILL to child process %d' % self.popen.pid)
-            self.popen.kill()
+    def popen_args(self):
+        """Returns the extra subprocess.Popen() arguments for the child."""
+        popen_args = {'start_new_session': True}
+        if self.cgroup is not None:
+            procs = os.path.join(self.cgroup, 'cgroup.procs')
+
+            def join_cgroup():
+                with open(procs, 'w') as fh:
+                    fh.write('0')
+            popen_args['preexec_fn'] = join_cgroup
+        return popen_args
+
+    def started(self, popen):
+        self.pgid = popen.pid
+
+    def signal(self, sig):
+        if self.cgroup is not None:
+            kill = os.path.join(self.cgroup, 'cgroup.kill')
+            if sig == signal.SIGKILL and os.path.exists(kill):
+                write_cgroup_file(kill, '1')
+                return
+            with open(os.path.join(self.cgroup, 'cgroup.procs')) as fh:
+                pids = [int(line) for line in fh]
+            for pid in pids:
+                try:
+                    os.kill(pid, sig)
+                except ProcessLookupError:
+                    pass
+        elif self.pgid is not None:
+            try:
+                os.killpg(self.pgid, sig)
+            except ProcessLookupError:
+                pass
+
+    def alive(self):
+        """Whether anything in the tree is still running."""
+        if self.cgroup is not None:
+            with open(os.path.join(self.cgroup, 'cgroup.events')) as fh:
+                return 'populated 1' in fh.read().splitlines()
+        if self.pgid is None:
+            return False
+        try:
+            pids = [pid for pid in os.listdir('/proc') if pid.isdigit()]
+        except OSError:
+            pids = None
+        if pids is None:
+            try:
+                os.killpg(self.pgid, 0)
+            except ProcessLookupError:
+                return False
+            except PermissionError:
+                pass
+            return True
+        # Zombies still count for killpg(), and orphans stay zombies for as
+        # long as init takes to reap them (forever, for some containers' init).
+        for pid in pids:
+            try:
+                with open('/proc/%s/stat' % pid) as fh:
+                    stat = fh.read().rsplit(')', 1)[1].split()
+            except (OSError, IndexError):
+                continue
+            if stat[0] != 'Z' and int(stat[2]) == self.pgid:
+                return True
+        return False
+
+    def memory_peak(self):
+        """Returns the most memory the tree has used at once, in bytes, or
+        None if we cannot tell."""
+        if self.cgroup is None:
+            return None
+        try:
+            with open(os.path.join(self.cgroup, 'memory.peak')) as fh:
+                return int(fh.read())
+        except (OSError, ValueError):
+            # No memory controller, or a kernel before 5.19.
+            return None
+
+    def close(self):
+        if self.cgroup is not None:
+            try:
+                os.rmdir(self.cgroup)
+            except OSError as e:
+                log('Could not remove %s, are processes left behind? %s' % (
+                    self.cgroup, e))
+
+
+def write_cgroup_file(path, value):
+    """Writes value to a cgroup control file, naming the file on errors
+    (which are otherwise hard to make sense of)."""
+    try:
+        with open(path, 'w') as fh:
+            fh.write(value)
+    except OSError as e:
+        raise OSError(e.errno, e.strerror, path)
+
+
+def reap(pid):
+    """Waits for child pid to exit. Returns (exit code, rusage)."""
+    _, status, rusage = os.wait4(pid, 0)
+    return os.waitstatus_to_exitcode(status), rusage
+
+
+def parse_size(size):
+    """Parses a size in bytes, with an optional K, M or G suffix."""
+    units = {'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30}
+    size = size.strip().upper()
+    if size[-1:] in units:
+        return int(float(size[:-1]) * units[size[-1]])
+    return int(size)
+
+
+def job_name(opts):
+    """Name to file a run under: --synchronous_name, or the subprocess."""
+    return opts.synchronous_name or os.path.basename(opts.subprocess)
 
 
 def log(message):
     """Logs a message to stderr if -v was specified.
-    
+
     Logs to syslog instead of stdout if --syslog was specified.
     """
     if args.verbose:
         if args.syslog:
             syslog.syslog(syslog.LOG_NOTICE, message)
         else:
-            print >>sys.stderr, message
+            print(message, file=sys.stderr)
+
+
+def lock_path(opts):
+    """Returns the lock file for opts.synchronous_name, creating
+    --synchronization_dir if necessary."""
+    if not os.path.isdir(opts.synchronization_dir):
+        log('--synchronization_dir does not exist, attempting to create')
+        os.makedirs(opts.synchronization_dir, exist_ok=True)
+    return os.path.join(opts.synchronization_dir, opts.synchronous_name)
 
 
-def get_lock():
-    """Gets a file lock, if necessary, and using params determined by flags.
+class Slots(object):
+    """A counting semaphore for opts.synchronous_name, shared by every
+    synchro.py on the host.
 
-    If we cannot obtain the lock, exit. (Either successfully or unsuccessfully,
-    depending on flags.)
+    Slot i is a flock on the lock file (slot 0, so that --slots 1 behaves like
+    the single lock we have always used) or on "<lock file>.<i>". Waiters
+    line up in "<lock file>.queue", one "pid starttime token" line each, and
+    only the head of the queue may take a free slot, so slots are handed out
+    in arrival order. Entries whose process has died are dropped whenever the
+    queue is read, so a killed waiter cannot hold up the queue.
     """
-    fh = None
-    # We don't do anything unless --synchronous_name is set.
-    if args.synchronous_name is not None:
-        if not os.path.isdir(args.synchronization_dir):
-            log('--synchronization_dir does not exist, attempting to create')
-            os.mkdir(args.synchronization_dir)
-
-        lock = os.path.join(args.synchronization_dir, args.synchronous_name)
-        fh = open(lock, 'w')
-        log('Acquiring lock on %s' % lock)
-        if args.nonblocking:
-            try:
-                fcntl.flock(fh, fcntl.LOCK_EX | fcntl.LOCK_NB)
-            except IOError:
-                log('We did not get the lock but --nonblocking is true; '
-                        'exiting successfully')
-                fh.close()
-                sys.exit(0)
-        else:
-            # Wait indefinitely. Hopefully there is a timeout on the synchro.py
-            # holding the lock.
+    def __init__(self, opts, token):
+        self.path = lock_path(opts)
+        self.count = opts.slots
+        self.token = token
+        self.fh = None
+
+    def slot_path(self, i):
+        return self.path if i == 0 else '%s.%d' % (self.path, i)
+
+    @contextlib.contextmanager
+    def queue(self):
+        """Yields the live waiters, which the caller may modify in place."""
+        with open(self.path + '.queue', 'a+') as fh:
             fcntl.flock(fh, fcntl.LOCK_EX)
+            fh.seek(0)
+            entries = [line.split() for line in fh if line.strip()]
+            waiters = [e for e in entries if alive(int(e[0]), e[1])]
+            before = list(waiters)
+            yield waiters
+            if waiters != entries or waiters != before:
+                fh.truncate(0)
+                fh.writelines(' '.join(e) + '\n' for e in waiters)
+
+    def try_acquire(self, enqueue=True):
+        """Takes a slot if one is free and nobody is queued ahead of us.
+
+        Otherwise returns False, joining the queue first if enqueue is set.
+        """
+        pid = self.token.split('.')[0]
+        with self.queue() as waiters:
+            tokens = [e[2] for e in waiters]
+            ahead = tokens.index(self.token) if self.token in tokens \
+                    else len(tokens)
+            if ahead == 0:
+                for i in range(self.count):
+                    fh = open(self.slot_path(i), 'w')
+                    try:
+                        fcntl.flock(fh, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    except IOError:
+                        fh.close()
+                        continue
+                    log('Got slot %d of %d for %s' % (
+                        i + 1, self.count, self.path))
+                    self.fh = fh
+                    waiters[:] = [e for e in waiters if e[2] != self.token]
+                    return True
+            if enqueue and self.token not in tokens:
+                log('Waiting for one of %d slots for %s (%d ahead of us)' % (
+                    self.count, self.path, ahead))
+                waiters.append([pid, start_time(int(pid)), self.token])
+            return False
+
+    def cancel(self):
+        """Leaves the queue without taking a slot."""
+        with self.queue() as waiters:
+            waiters[:] = [e for e in waiters if e[2] != self.token]
+
+    def release(self):
+        if self.fh is not None:
+            self.fh.close()
+            self.fh = None
+
+
+def start_time(pid):
+    """Returns pid's start time, to tell it apart from a later process that
+    reuses the pid, or '-' if we cannot tell."""
+    try:
+        with open('/proc/%d/stat' % pid) as fh:
+            return fh.read().rsplit(')', 1)[1].split()[19]
+    except (OSError, IndexError):
+        return '-'
+
+
+def alive(pid, started):
+    """Whether the process that queued as (pid, started) is still running."""
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return started == '-' or start_time(pid) in (started, '-')
+
+
+def splay():
+    """Sleeps for this host's share of --splay, if we should splay."""
+    time.sleep(splay_delay(args))
+
+
+def splay_delay(opts):
+    """Returns how long to delay the start of the job described by opts for
+    --splay, in seconds: 0 if we should not splay."""
+    if not opts.splay:
+        return 0
+    if opts.splay_if_load is not None or opts.splay_if_pressure is not None:
+        why = host_busy(opts)
+        if why is None:
+            log('Host is not busy; not splaying')
+            return 0
+    else:
+        why = '--splay'
+    # Python's hash() varies from run to run, so it will not do.
+    key = '%s %s' % (socket.gethostname(), opts.synchronous_name or
+            os.path.basename(opts.subprocess or opts.argv_file))
+    digest = hashlib.sha256(key.encode()).digest()
+    delay = opts.splay * int.from_bytes(digest[:8], 'big') / float(1 << 64)
+    log('Splaying start by %.1fs of %ss (%s)' % (delay, opts.splay, why))
+    return delay
+
+
+def host_busy(opts):
+    """Returns why the host is busy by --splay_if_load or
+    --splay_if_pressure, or None if it is not."""
+    if opts.splay_if_load is not None:
+        load = os.getloadavg()[0] / (os.cpu_count() or 1)
+        if load > opts.splay_if_load:
+            return 'load %.2f per CPU' % load
+    if opts.splay_if_pressure is not None:
+        for resource in ('cpu', 'io', 'memory'):
+            try:
+                with open('/proc/pressure/%s' % resource) as fh:
+                    some = fh.readline().split()
+            except OSError:
+                # Not Linux, or a kernel without PSI.
+                continue
+            fields = dict(field.split('=') for field in some[1:])
+            if float(fields['avg10']) > opts.splay_if_pressure:
+                return '%s pressure %s%%' % (resource, fields['avg10'])
+    return None
+
+
+def history_path(opts):
+    return opts.history or os.path.join(opts.synchronization_dir,
+            'history.db')
+
+
+def open_history(opts):
+    db = sqlite3.connect(history_path(opts), timeout=30)
+    db.execute("""CREATE TABLE IF NOT EXISTS runs (
+            name TEXT NOT NULL,
+            started REAL NOT NULL,
+            duration REAL NOT NULL,
+            lock_wait REAL NOT NULL,
+            returncode INTEGER NOT NULL,
+            timed_out INTEGER NOT NULL,
+            utime REAL,
+            stime REAL,
+            maxrss INTEGER,
+            inblock INTEGER,
+            oublock INTEGER,
+            nvcsw INTEGER,
+            nivcsw INTEGER,
+            output BLOB,
+            rss_floor INTEGER)""")
+    db.execute('CREATE INDEX IF NOT EXISTS runs_by_name ON runs '
+            '(name, started)')
+    # Histories from before we saved output, or rss_floor.
+    columns = [row[1] for row in db.execute('PRAGMA table_info(runs)')]
+    if 'output' not in columns:
+        db.execute('ALTER TABLE runs ADD COLUMN output BLOB')
+    if 'rss_floor' not in columns:
+        db.execute('ALTER TABLE runs ADD COLUMN rss_floor INTEGER')
+    return db
+
+
+def record_run(opts, started, duration, lock_wait, returncode, timed_out,
+        rusage, output=None, memory_peak=None, rss_floor=None):
+    """Adds a run to the history, keyed by --synchronous_name (or the
+    subprocess's name, for unsynchronized runs).
+
+    started is a Unix timestamp; duration and lock_wait are in seconds.
+    timed_out is None, TIMEOUT or IDLE_TIMEOUT. memory_peak, in bytes, is
+    recorded instead of rusage's peak RSS if given. Otherwise rss_floor is
+    our own peak RSS when we started the subprocess, in KiB, as much of
+    which as the subprocess shared before it exec()ed counts towards its
+    peak RSS.
+    """
+    if opts.no_history:
+        return
+    name = job_name(opts)
+    try:
+        os.makedirs(opts.synchronization_dir, exist_ok=True)
+        db = open_history(opts)
+        with db:
+            db.execute('INSERT INTO runs (name, started, duration, '
+                    'lock_wait, returncode, timed_out, utime, stime, maxrss, '
+                    'inblock, oublock, nvcsw, nivcsw, output, rss_floor) '
+                    'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', (
+                    name, started, duration, lock_wait, returncode,
+                    timed_out or 0, rusage.ru_utime, rusage.ru_stime,
+                    rusage.ru_maxrss if memory_peak is None else
+                        memory_peak >> 10,
+                    rusage.ru_inblock, rusage.ru_oublock,
+                    rusage.ru_nvcsw, rusage.ru_nivcsw,
+                    bytes(output.tail) if output and output.keep else None,
+                    rss_floor if memory_peak is None else None))
+        db.close()
+    except sqlite3.Error as e:
+        log('Could not record run in %s: %s' % (history_path(opts), e))
+
+
+def percentile(values, p):
+    """Returns the p-th percentile of values (nearest rank)."""
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * p / 100))]
+
+
+def trend(values):
+    """Compares the median of the newer half of values (oldest first) with
+    the older half, as a percentage change."""
+    if len(values) < 4:
+        return '-'
+    half = len(values) // 2
+    old, new = percentile(values[:half], 50), percentile(values[-half:], 50)
+    if not old:
+        return '-'
+    return '%+.0f%%' % (100.0 * (new - old) / old)
+
+
+def report():
+    """Prints a summary of the recent runs of each job in the history."""
+    if not os.path.exists(history_path(args)):
+        print('No history in %s' % history_path(args), file=sys.stderr)
+        return 1
+    db = open_history(args)
+    if args.synchronous_name is not None:
+        names = [args.synchronous_name]
+    else:
+        names = [row[0] for row in
+                db.execute('SELECT DISTINCT name FROM runs ORDER BY name')]
+    columns = ('name', 'runs', 'last run', 'p50 s', 'p95 s', 'time trend',
+            'p50 wait s', 'p95 cpu s', 'p95 rss MiB', 'rss trend',
+            'p95 io MiB', 'failed', 'timeouts', 'idle kills')
+    rows = []
+    floors = []
+    for name in names:
+        # Oldest first, so the trends compare older runs with newer ones.
+        runs = db.execute('SELECT * FROM (SELECT started, duration, '
+                'lock_wait, returncode, timed_out, utime + stime, maxrss, '
+                'inblock + oublock, rss_floor FROM runs WHERE name = ? '
+                'ORDER BY started DESC LIMIT ?) ORDER BY started',
+                (name, args.report_runs)).fetchall()
+        if not runs:
+            continue
+        started, duration, wait, returncode, timed_out, cpu, rss, io, \
+                floor = zip(*runs)
+        floors.extend(f for f in floor if f is not None)
+        rows.append((name, str(len(runs)),
+                datetime.datetime.fromtimestamp(started[-1]).strftime(
+                    '%Y-%m-%d %H:%M'),
+                '%.1f' % percentile(duration, 50),
+                '%.1f' % percentile(duration, 95),
+                trend(duration),
+                '%.1f' % percentile(wait, 50),
+                '%.1f' % percentile(cpu, 95),
+                # ru_maxrss is in KiB, block I/O in 512-byte blocks.
+                '%.0f' % (percentile(rss, 95) / 1024.0),
+                trend(rss),
+                '%.0f' % (percentile(io, 95) / 2048.0),
+                str(sum(1 for r in returncode if r != 0)),
+                str(sum(1 for t in timed_out if t == TIMEOUT)),
+                str(sum(1 for t in timed_out if t == IDLE_TIMEOUT))))
+    failed = None
+    if args.synchronous_name is not None:
+        failed = db.execute('SELECT started, output FROM runs '
+                'WHERE name = ? AND returncode != 0 AND output IS NOT NULL '
+                'ORDER BY started DESC LIMIT 1',
+                (args.synchronous_name,)).fetchone()
+    db.close()
+    widths = [max(len(r[i]) for r in rows + [columns])
+            for i in range(len(columns))]
+    for row in [columns] + rows:
+        print('  '.join(cell.ljust(w) if i == 0 else cell.rjust(w)
+                for i, (cell, w) in enumerate(zip(row, widths))))
+    if floors:
+        # See record_run().
+        print("\nrss is the subprocess's peak RSS, which counts what it "
+                'shared with synchro.py\nbefore it exec()ed: up to %.0f MiB '
+                "in these runs. Use --cgroup to measure\nthe subprocess's "
+                'own memory instead.' % (max(floors) / 1024.0))
+    if failed is not None:
+        print('\nEnd of output of the last failed run, at %s:' %
+                datetime.datetime.fromtimestamp(failed[0]).strftime(
+                    '%Y-%m-%d %H:%M'))
+        sys.stdout.flush()
+        sys.stdout.buffer.write(failed[1])
+    return 0
+
+
+async def run_commands(commands):
+    """Runs each argv in commands with the options in args. Returns the exit
+    code for synchro.py."""
+    loop = asyncio.get_running_loop()
+    trees = set()
+    waiting = set()
+    # Subprocesses are in sessions of their own, so pass on the signals they
+    # would otherwise have got along with us. Jobs that are still waiting for
+    # a slot give up instead, so that they don't start after we were told to
+    # stop.
+    for signum in (signal.SIGINT, signal.SIGTERM, signal.SIGHUP):
+        loop.add_signal_handler(signum, forward_signal, trees, waiting,
+                signum)
+    jobs = []
+    for i, argv in enumerate(commands):
+        opts = argparse.Namespace(**vars(args))
+        opts.subprocess, opts.subprocess_args = argv[0], argv[1:]
+        token = str(os.getpid())
+        if len(commands) > 1:
+            token = '%d.%d' % (os.getpid(), i)
+        jobs.append(run_job(opts, token, trees=trees, waiting=waiting))
+    return max(await asyncio.gather(*jobs))
+
+
+def forward_signal(trees, waiting, signum):
+    for tree in trees:
+        tree.signal(signum)
+    for task in waiting:
+        task.cancel()
+
+
+async def run_job(opts, token, fds=(0, 1, 2), cwd=None, env=None, conn=None,
+        trees=None, waiting=None):
+    """Runs the subprocess described by opts, from waiting for a slot to
+    recording the run. Returns the exit code for synchro.py.
+
+    token identifies the job in lock queues and cgroups. The subprocess gets
+    fds as its stdin, stdout and stderr. If conn is given, it is the socket
+    of the client the job is for, and we give up if the client goes away.
+    trees, if given, is a set to hold the job's ProcessTree while it runs.
+    waiting, if given, is a set to hold the job's task while it waits for a
+    slot; cancelling it there leaves the queue and returns 3.
+    """
+    slots = None
+    t_wait = time.monotonic()
+    if opts.synchronous_name is not None:
+        log('Acquiring lock for %s' % opts.synchronous_name)
+        task = asyncio.current_task()
+        if waiting is not None:
+            waiting.add(task)
+        try:
+            slots = await acquire(opts, token, conn)
+        except asyncio.CancelledError:
+            if waiting is None:
+                raise
+            log('Stopped waiting for %s' % opts.synchronous_name)
+            return 3
+        finally:
+            if waiting is not None:
+                waiting.discard(task)
+        if slots is None:
+            if opts.nonblocking:
+                log('%s is busy but --nonblocking is true; '
+                        'reporting success' % opts.synchronous_name)
+            return 0
         log('Lock acquired')
-    return fh
+    try:
+        return await supervise(opts, token, fds, cwd, env, conn,
+                time.monotonic() - t_wait, trees)
+    finally:
+        if slots is not None:
+            slots.release()
 
 
-def main():
-    fh = get_lock()
+async def acquire(opts, token, conn=None):
+    """Gets a slot for opts.synchronous_name.
+
+    Returns the Slots, or None if there is no free slot and opts.nonblocking
+    is set, or if the client went away while waiting.
+    """
+    slots = Slots(opts, token)
+    try:
+        # Wait indefinitely. Hopefully there is a timeout on the synchro.py
+        # ahead of us.
+        while not slots.try_acquire(enqueue=not opts.nonblocking):
+            if opts.nonblocking:
+                return None
+            if conn is not None and hung_up(conn):
+                log('Client went away while waiting for %s' % slots.path)
+                slots.cancel()
+                return None
+            await asyncio.sleep(LOCK_POLL_INTERVAL)
+    except BaseException:
+        slots.cancel()
+        raise
+    return slots
+
 
-    t = ProcessThread([args.subprocess] + args.subprocess_args)
+async def supervise(opts, token, fds, cwd, env, conn, lock_wait, trees):
+    """Runs the subprocess, enforcing the timeouts. See run_job()."""
+    loop = asyncio.get_running_loop()
+    argv = [opts.subprocess] + opts.subprocess_args
     log('starting subprocess: subprocess=%s, args=%s' % (
-        args.subprocess, args.subprocess_args))
-    t_start = datetime.datetime.now()
-    t.start()
-
-    t.join(args.timeout)
-    if t.isAlive():
-        # If the thread is still alive, we timed out.
-        t.terminate()
-        t.join(args.kill_timeout)
-        if t.isAlive():
-            t.kill()
-
-    # The thread has already terminated, or we have forced its subprocess to
-    # end, so it is safe to join() with no timeout here.
-    t.join()
-    t_end = datetime.datetime.now()
-    time_taken = t_end - t_start
-    log('Took %s' % time_taken)
-
-    if fh is not None:
-        fh.close()
-
-    if t.popen is not None:
-        log('pid = %d, ret = %d' % (t.popen.pid, t.popen.returncode))
-        if t.popen.returncode != 0:
-            return 4
-    else:
+        opts.subprocess, opts.subprocess_args))
+    tree = output = None
+    popen_args = {'stdin': fds[0], 'stdout': fds[1], 'stderr': fds[2],
+            'cwd': cwd, 'env': env}
+    if opts.idle_timeout is not None or opts.save_output:
+        output = Output(opts.save_output << 10, fds[1], fds[2])
+        popen_args.update(output.popen_args())
+    try:
+        tree = ProcessTree(opts, token)
+        popen_args.update(tree.popen_args())
+        # The child's peak RSS counts what it shares with us before exec(),
+        # even with vfork().
+        rss_floor = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        popen = subprocess.Popen(argv, **popen_args)
+    except (OSError, subprocess.SubprocessError) as e:
+        log('Could not start %s: %s' % (opts.subprocess, e))
+        os.write(fds[2], ('%s\n' % e).encode())
+        if tree is not None:
+            tree.close()
+        if output is not None:
+            output.started()
+            output.start(loop)
+            await output.finish()
         return 3
+    tree.started(popen)
+    if trees is not None:
+        trees.add(tree)
+    started, t_start = time.time(), time.monotonic()
+    timed_out = None
+    if output is not None:
+        output.started()
+        output.start(loop)
+
+    exited = loop.create_future()
+    pidfd = os.pidfd_open(popen.pid)
+
+    def reap_child():
+        # Reap right away, so that our zombie does not keep the process group
+        # alive.
+        loop.remove_reader(pidfd)
+        exited.set_result(reap(popen.pid))
+    loop.add_reader(pidfd, reap_child)
+    client_gone = loop.create_future()
+    if conn is not None:
+        loop.add_reader(conn.fileno(), set_once, client_gone, conn.fileno())
+    deadline = None
+    if opts.timeout is not None:
+        deadline = t_start + opts.timeout
+    try:
+        while True:
+            wake = deadline
+            if opts.idle_timeout is not None:
+                idle_deadline = output.last + opts.idle_timeout
+                wake = min(wake or idle_deadline, idle_deadline)
+            done, _ = await asyncio.wait([exited, client_gone],
+                    timeout=None if wake is None else
+                        max(0, wake - time.monotonic()),
+                    return_when=asyncio.FIRST_COMPLETED)
+            now = time.monotonic()
+            if client_gone in done:
+                log('Client for pid %d went away' % popen.pid)
+                timed_out = TIMEOUT
+            elif done:
+                break
+            elif deadline is not None and now >= deadline:
+                log('Timed out after %ss' % opts.timeout)
+                timed_out = TIMEOUT
+            elif (opts.idle_timeout is not None and
+                    now >= output.last + opts.idle_timeout):
+                log('No output for %ss' % opts.idle_timeout)
+                timed_out = IDLE_TIMEOUT
+            if timed_out:
+                break
+        if not exited.done():
+            log('Sending SIGTERM to child process %d and its %s' % (
+                popen.pid, tree))
+            tree.signal(signal.SIGTERM)
+            deadline = time.monotonic() + opts.kill_timeout
+            await asyncio.wait([exited], timeout=opts.kill_timeout)
+            # The child may have exited while others in its tree have not.
+            while tree.alive() and time.monotonic() < deadline:
+                await asyncio.sleep(TREE_POLL_INTERVAL)
+            if not exited.done() or tree.alive():
+                log('Sending SIGKILL to child process %d and its %s' % (
+                    popen.pid, tree))
+                tree.signal(signal.SIGKILL)
+                await exited
+    finally:
+        loop.remove_reader(pidfd)
+        os.close(pidfd)
+        if conn is not None:
+            loop.remove_reader(conn.fileno())
+        if trees is not None:
+            trees.discard(tree)
+        memory_peak = tree.memory_peak()
+        tree.close()
+        if output is not None:
+            await output.finish()
+
+    popen.returncode, rusage = exited.result()
+    duration = time.monotonic() - t_start
+    log('Took %s' % datetime.timedelta(seconds=duration))
+    log('pid = %d, ret = %d' % (popen.pid, popen.returncode))
+    record_run(opts, started, duration, lock_wait, popen.returncode,
+            timed_out, rusage, output, memory_peak, rss_floor)
+    return 4 if popen.returncode != 0 else 0
+
+
+class Supervisor(object):
+    """Runs jobs submitted by synchro.py clients, all in one event loop.
+
+    Each client connection carries one job: a JSON request with the
+    client's command line, cwd and environment, plus its stdin, stdout and
+    stderr as SCM_RIGHTS file descriptors. We parse the command line, do any
+    --splay, and reply with the exit code the client should exit with, or
+    with null if the command line is not for a job (it has a usage error, or
+    is for --report, say), so that the client deals with it itself. If the
+    client goes away before the job is done, we treat that like a timeout.
+
+    Jobs wait for --slots in the same on-disk queue as standalone synchro.py
+    invocations, so both are served in one first-come, first-served order.
+
+    On SIGINT, SIGTERM or SIGHUP we stop listening, pass the signal on to
+    every running job, and give up on the ones still waiting for a slot or in
+    their --splay. Jobs that are still running --kill_timeout later get
+    SIGKILL. Every client gets its reply (or, failing that, a closed
+    connection) before we exit.
+    """
+    def __init__(self):
+        self.tokens = itertools.count()
+        # The event loop only keeps weak references to tasks.
+        self.tasks = set()
+        self.trees = set()
+        self.waiting = set()
+        self.stopping = None
+
+    async def serve(self, path):
+        loop = asyncio.get_running_loop()
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        if os.path.exists(path):
+            os.unlink(path)
+        sock.bind(path)
+        os.chmod(path, 0o600)
+        sock.listen(128)
+        sock.setblocking(False)
+        self.stopping = loop.create_future()
+        for signum in (signal.SIGINT, signal.SIGTERM, signal.SIGHUP):
+            loop.add_signal_handler(signum, self.stop, signum)
+        log('Supervisor listening on %s' % path)
+        accepting = asyncio.create_task(self.accept(sock))
+        try:
+            signum = await self.stopping
+        finally:
+            accepting.cancel()
+            sock.close()
+            os.unlink(path)
+        log('Got signal %d; stopping %d jobs' % (signum, len(self.tasks)))
+        forward_signal(self.trees, self.waiting, signum)
+        if not self.tasks:
+            return
+        _, pending = await asyncio.wait(self.tasks, timeout=args.kill_timeout)
+        if not pending:
+            return
+        log('Killing %d jobs' % len(self.trees))
+        for tree in self.trees:
+            if tree.alive():
+                tree.signal(signal.SIGKILL)
+        _, pending = await asyncio.wait(pending, timeout=args.kill_timeout)
+        if not pending:
+            return
+        # Whatever is left is stuck on its client; hang up on it.
+        for task in pending:
+            task.cancel()
+        await asyncio.wait(pending)
+
+    def stop(self, signum):
+        if not self.stopping.done():
+            self.stopping.set_result(signum)
+
+    async def accept(self, sock):
+        loop = asyncio.get_running_loop()
+        while True:
+            conn, _ = await loop.sock_accept(sock)
+            task = asyncio.create_task(self.handle(conn))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+
+    async def handle(self, conn):
+        loop = asyncio.get_running_loop()
+        fds = []
+        try:
+            # Only run jobs for our own user.
+            creds = conn.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED,
+                    12)
+            uid = int.from_bytes(creds[4:8], sys.byteorder)
+            if uid != os.getuid():
+                log('Rejecting job from uid %d' % uid)
+                return
+            await wait_readable(conn)
+            msg, fds, _, _ = socket.recv_fds(conn, MAX_MESSAGE, 3)
+            request = json.loads(msg)
+            returncode = await self.run_request(request, fds, conn)
+            await loop.sock_sendall(conn,
+                    json.dumps({'returncode': returncode}).encode())
+        except Exception as e:
+            log('Error handling job: %r' % e)
+        finally:
+            for fd in fds:
+                os.close(fd)
+            conn.close()
+
+    async def run_request(self, request, fds, conn):
+        try:
+            # Leave any usage message to the client.
+            with contextlib.redirect_stdout(io.StringIO()), \
+                    contextlib.redirect_stderr(io.StringIO()):
+                opts = parse_args(request['argv'], request['env'])
+        except SystemExit:
+            return None
+        if opts.serve or opts.report or opts.argv_file is not None:
+            return None
+        # Don't start anything new once we have been told to stop.
+        if self.stopping.done():
+            return 3
+        task = asyncio.current_task()
+        self.waiting.add(task)
+        try:
+            await asyncio.sleep(splay_delay(opts))
+        except asyncio.CancelledError:
+            return 3
+        finally:
+            self.waiting.discard(task)
+        token = '%d.%d' % (os.getpid(), next(self.tokens))
+        return await run_job(opts, token, fds, request['cwd'],
+                request['env'], conn, self.trees, self.waiting)
+
+
+def set_once(future, fd):
+    """Event loop reader callback that completes future, once."""
+    asyncio.get_running_loop().remove_reader(fd)
+    if not future.done():
+        future.set_result(None)
+
+
+def hung_up(sock):
+    """Whether the peer has closed sock, without consuming any data."""
+    try:
+        return sock.recv(1, socket.MSG_PEEK | socket.MSG_DONTWAIT) == b''
+    except BlockingIOError:
+        return False
+
+
+async def wait_readable(sock):
+    loop = asyncio.get_running_loop()
+    readable = loop.create_future()
+    loop.add_reader(sock.fileno(), set_once, readable, sock.fileno())
+    try:
+        await readable
+    finally:
+        loop.remove_reader(sock.fileno())
+
+
+def serve():
+    path = args.socket or os.path.join(args.synchronization_dir,
+            'supervisor.sock')
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    asyncio.run(Supervisor().serve(path))
+    return 0
+
+
+def main():
+    if args.serve:
+        return serve()
+    if args.report:
+        return report()
+    if args.socket is not None:
+        why = no_supervisor
+        if supervisor_socket is None:
+            # Spelled in a way socket_arg() does not know, so we have not
+            # tried the supervisor yet.
+            returncode, why = submit(args.socket, sys.argv[1:])
+            if returncode is not None:
+                return returncode
+        log('Not using the supervisor on %s (%s); running the job '
+                'ourselves' % (args.socket, why))
+    splay()
+
+    if args.argv_file is not None:
+        commands = read_argv_file(args.argv_file)
+        if not commands:
+            log('No commands in %s' % args.argv_file)
+            return 0
+    else:
+        commands = [[args.subprocess] + args.subprocess_args]
+    return asyncio.run(run_commands(commands))
+
+
+def read_argv_file(path):
+    commands = []
+    with open(path) as fh:
+        for line in fh:
+            argv = shlex.split(line, comments=True)
+            if argv:
+                commands.append(argv)
+    return commands
+
+
+def parse_args(argv, env=os.environ):
+    """Parses a synchro.py command line, run with environment env. Exits with
+    a usage message if it is not valid."""
+    opts = parser.parse_args(argv)
+    if opts.synchronization_dir is None:
+        opts.synchronization_dir = env.get('HOME', '') + '/.cache/synchro.py'
+    if (not (opts.serve or opts.report or opts.argv_file) and
+            opts.subprocess is None):
+        parser.error('the following arguments are required: subprocess')
+    if opts.argv_file is not None and opts.subprocess is not None:
+        parser.error('give either --argv_file or subprocess, not both')
+    if opts.argv_file is not None and opts.socket is not None:
+        parser.error('--argv_file cannot be used with --socket')
+    if opts.slots < 1:
+        parser.error('--slots must be at least 1')
+    if opts.cgroup is None and (opts.cpu_max or opts.memory_max):
+        parser.error('--cpu_max and --memory_max need --cgroup')
+    return opts
 
 
-args = parser.parse_args()
-main()
+args = parse_args(sys.argv[1:])
+sys.exit(main())
@@ -0,0 +1,175 @@
+# Benchmarks for untar.py's decompressors.
+#
+# gen writes a synthetic tree of files (a mix of text-like and random data,
+# so that it compresses about 3:1), archives it, and compresses the archive
+# in each format there's a tool for: gzip (pigz if we have it), bzip2
+# (lbzip2 or pbzip2 if we have them), xz -T0 and zstd -T0. The xz file is
+# multi-block, so that it can be decompressed in parallel.
+#
+# run extracts each archive with untar.py --single-pass, once with tar's own
+# decompressor and once per thread count with each parallel decompressor
+# untar.py knows about and finds installed. It reports wall time, throughput
+# (of the uncompressed archive) and CPU time. The archives are read from the
+# page cache after the first run, and the extracted files are written into
+# the same directory, so put it on the filesystem you care about.
+#
+# Example usage:
+#   python ./untar-bench.py gen --size-mb 1024 /tmp/untar-bench
+#   python ./untar-bench.py run --threads 1,4,16,32 /tmp/untar-bench
+
+import argparse
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import untar
+
+_UNTAR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'untar.py')
+
+# (suffix, compressors to try in order of preference)
+_FORMATS = [
+    ('.tar.gz', [['pigz', '-c'], ['gzip', '-c']]),
+    ('.tar.bz2', [['lbzip2', '-c'], ['pbzip2', '-c'], ['bzip2', '-c']]),
+    ('.tar.xz', [['xz', '-T0', '-c']]),
+    ('.tar.zst', [['zstd', '-T0', '-q', '-c']]),
+]
+
+
+def gen(args):
+    rng = random.Random(args.seed)
+    words = [
+        ''.join(rng.choice('etaoinshrdlu') for _ in range(rng.randint(2, 9)))
+        for _ in range(2000)
+    ]
+    text = ' '.join(rng.choice(words) for _ in range(200000)).encode()
+    tree = os.path.join(args.directory, 'tree')
+    os.makedirs(tree, exist_ok=True)
+    file_size = args.size_mb * 2**20 // args.files
+    for i in range(args.files):
+        subdir = os.path.join(tree, f'd{i % 16:02d}')
+        os.makedirs(subdir, exist_ok=True)
+        with open(os.path.join(subdir, f'f{i:06d}'), 'wb') as fh:
+            left = file_size
+            while left > 0:
+                n = min(left, 64 * 1024)
+                if rng.random() < 0.25:
+                    fh.write(rng.randbytes(n))
+                else:
+                    start = rng.randrange(len(text) - n)
+                    fh.write(text[start:start + n])
+                left -= n
+
+    tar_path = os.path.join(args.directory, 'bench.tar')
+    subprocess.check_call(['tar', '-cf', tar_path, '-C', args.directory, 'tree'])
+    shutil.rmtree(tree)
+    print(f'{tar_path}: {os.path.getsize(tar_path) / 2**20:.0f} MiB')
+    for suffix, compressors in _FORMATS:
+        for cmd in compressors:
+            if shutil.which(cmd[0]):
+                break
+        else:
+            print(f'{suffix}: no compressor installed, skipping')
+            continue
+        out_path = os.path.join(args.directory, 'bench' + suffix)
+        start = time.monotonic()
+        with open(tar_path, 'rb') as fin, open(out_path, 'wb') as fout:
+            subprocess.check_call(cmd, stdin=fin, stdout=fout)
+        print(f'{out_path}: {os.path.getsize(out_path) / 2**20:.0f} MiB '
+              f'({" ".join(cmd)}, {time.monotonic() - start:.1f}s)')
+
+
+def measure(argv, cwd):
+    """Runs argv in cwd, and returns (wall seconds, CPU seconds) for it and
+    everything it started."""
+    start = time.monotonic()
+    proc = subprocess.Popen(argv, cwd=cwd)
+    _, status, rusage = os.wait4(proc.pid, 0)
+    wall = time.monotonic() - start
+    returncode = os.waitstatus_to_exitcode(status)
+    if returncode:
+        raise RuntimeError(f'{argv} exited with status {returncode}')
+    return wall, rusage.ru_utime + rusage.ru_stime
+
+
+def run(args):
+    tar_path = os.path.join(args.directory, 'bench.tar')
+    size = os.path.getsize(tar_path) / 2**20
+    if args.threads:
+        thread_counts = [int(n) for n in args.threads.split(',')]
+    else:
+        thread_counts = [1]
+        while thread_counts[-1] * 2 <= (os.cpu_count() or 1):
+            thread_counts.append(thread_counts[-1] * 2)
+
+    print(f'{"archive":<10} {"decompressor":<13} {"threads":>7} '
+          f'{"wall (s)":>9} {"MiB/s":>8} {"CPU (s)":>8}')
+    for suffix, _ in _FORMATS:
+        path = os.path.join(args.directory, 'bench' + suffix)
+        if not os.path.exists(path):
+            continue
+        runs = [('tar', None)]
+        for name, cmd in untar._DECOMPRESSORS.get(
+                untar.compression_format(path), []):
+            if shutil.which(cmd[0]):
+                runs += [(name, n) for n in thread_counts]
+        for name, threads in runs:
+            argv = [sys.executable, _UNTAR, '--single-pass',
+                    f'--decompressor={name}']
+            if threads is not None:
+                argv.append(f'--threads={threads}')
+            best = None
+            for _ in range(args.repeat):
+                workdir = tempfile.mkdtemp(prefix='untar-bench.',
+                                           dir=args.directory)
+                try:
+                    result = measure(argv + [os.path.abspath(path)], workdir)
+                finally:
+                    shutil.rmtree(workdir)
+                if best is None or result[0] < best[0]:
+                    best = result
+            wall, cpu = best
+            print(f'{suffix[1:]:<10} {name:<13} {threads or "-":>7} '
+                  f'{wall:>9.2f} {size / wall:>8.1f} {cpu:>8.2f}')
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    gn = subparsers.add_parser(
+        'gen', help='Write a synthetic archive in each compression format.')
+    gn.add_argument('directory')
+    gn.add_argument('--size-mb',
+                    help='Size of the uncompressed archive.',
+                    type=int,
+                    default=256)
+    gn.add_argument('--files',
+                    help='Number of files in the archive.',
+                    type=int,
+                    default=256)
+    gn.add_argument('--seed', type=int, default=0)
+    gn.set_defaults(func=gen)
+
+    rn = subparsers.add_parser(
+        'run', help='Time untar.py on the archives written by gen.')
+    rn.add_argument('directory')
+    rn.add_argument('--threads',
+                    help='Comma separated thread counts to try (default: '
+                    'powers of two up to the number of CPUs).')
+    rn.add_argument('--repeat',
+                    help='Runs of each configuration; the fastest counts.',
+                    type=int,
+                    default=1)
+    rn.set_defaults(func=run)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
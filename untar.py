@@ -17,6 +17,38 @@
 #    necessary). If your tar auto-detects tarred+compressed files and
 #    auto-expands them, then you shouldn't actually need to do this.
 #
+# $ untar.py --single-pass big.tar.zst
+# -> Reads big.tar.zst only once: extracts it into a staging directory next
+#    to the target, then renames its single root directory (or the whole
+#    staging directory, as 'big', if it's a tarbomb) into place. Without
+#    --single-pass, untar.py lists the archive first to decide where to
+#    extract, which means decompressing it twice. The target must not
+#    already exist.
+#
+# $ untar.py --threads=8 huge.tar.xz
+# -> Decompresses with a parallel tool, if there is one for the archive's
+#    format, and pipes the result into tar: pigz for gzip, lbzip2 or pbzip2
+#    for bzip2, and xz -T for xz (which only helps with multi-block files,
+#    e.g. those made by xz -T0). The default is one thread per CPU.
+#    --decompressor=NAME picks one of those tools by name, or 'tar' to let
+#    tar decompress on its own as usual.
+#
+# $ untar.py --jobs=8 releases/*.tar.gz
+# -> Extracts up to 8 archives at a time, then prints how many files and
+#    bytes tar extracted from each one, and how long it took. At most --per-fs-jobs
+#    of them (default: 1 on a spinning disk, otherwise no limit) read from
+#    or write to the same filesystem at once.
+#
+# $ untar.py --index huge.tar.gz
+# $ untar.py --member=huge/docs/README huge.tar.gz
+# -> --index extracts as usual, and on the way records where each member
+#    starts in a sidecar file, huge.tar.gz.untar-index. For gzip (BGZF, as
+#    written by bgzip) and zstd archives made of several frames, it also
+#    records where decompression can start afresh. --member (which can be
+#    repeated) then extracts just the given member(s), starting from the
+#    closest such point: straight away for an uncompressed archive, and
+#    without reading the rest of the archive for any of them.
+#
 # untar.py always passes '-x', '-f', and '-C FILE' to tar, so passing them
 # explicitly doesn't make any sense.
 #
@@ -25,40 +57,264 @@
 # Sat Oct 29 22:01:23 EDT 2011
 # -----------------------------------------------------------------
 
+import collections
+import contextlib
+import functools
+import json
 import os
 import re
+import shutil
+import signal
+import struct
 import subprocess
 import sys
+import tarfile
+import tempfile
+import threading
+import time
 
 _TAR = '/bin/tar'
 
-def tar_list(tar_file):
-  """Returns a list of all files in the given tar file.
+# (format, leading bytes of a file in that format)
+_MAGIC = [
+  ('gzip', b'\x1f\x8b'),
+  ('bzip2', b'BZh'),
+  ('xz', b'\xfd7zXZ\x00'),
+  ('zstd', b'\x28\xb5\x2f\xfd'),
+]
+
+# Parallel decompressors for each format, in order of preference. Each
+# writes the decompressed archive to stdout. tar already runs the usual
+# single-threaded tool as a separate process, so zstd has no entry: its
+# decompression is single-threaded however it's run.
+_DECOMPRESSORS = {
+  'gzip': [('pigz', ['pigz', '-d', '-c', '-p', '{threads}'])],
+  'bzip2': [('lbzip2', ['lbzip2', '-d', '-c', '-n', '{threads}']),
+            ('pbzip2', ['pbzip2', '-d', '-c', '-p{threads}'])],
+  'xz': [('xz', ['xz', '-d', '-c', '-T', '{threads}'])],
+}
 
-  Returns: ([str], str) A tuple of the list of files (or None) and any stderr
-           output from tar.
+# Plain decompressors, for when we need to decompress ourselves and there's
+# no parallel one. Each reads stdin if not given a file.
+_DECOMPRESS = {
+  'gzip': ['gzip', '-d', '-c'],
+  'bzip2': ['bzip2', '-d', '-c'],
+  'xz': ['xz', '-d', '-c'],
+  'zstd': ['zstd', '-d', '-c', '-q'],
+}
+
+_INDEX_SUFFIX = '.untar-index'
+# Record decompression checkpoints no closer together than this, in
+# uncompressed bytes.
+_CHECKPOINT_SPACING = 4 * 2**20
+_BUFSIZE = 2**20
+
+# tar flags that choose a decompressor themselves.
+_TAR_COMPRESSION_FLAGS = set([
+  '--auto-compress', '--bzip2', '--compress', '--gunzip', '--gzip',
+  '--lzip', '--lzma', '--lzop', '--uncompress', '--ungzip',
+  '--use-compress-program', '--xz', '--zstd'])
+_TAR_COMPRESSION_SHORT_FLAGS = 'IJZajz'
+# Short tar flags that take an argument, which may be attached.
+_TAR_SHORT_FLAGS_WITH_ARG = 'CFHIKLNTVXbfg'
+
+def compression_format(tar_file):
+  """Returns the compression format of tar_file, going by its first few
+  bytes, or None.
   """
-  proc = subprocess.Popen([_TAR, '-tf', tar_file],
-                          stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-  stdout, stderr = proc.communicate()
-  if proc.returncode:
-    return (None, stderr)
-  else:
-    return (stdout.strip().split('\n'), stderr)
+  try:
+    with open(tar_file, 'rb') as fh:
+      head = fh.read(8)
+  except (IOError, OSError):
+    return None
+  for fmt, magic in _MAGIC:
+    if head.startswith(magic):
+      return fmt
+  return None
+
+
+def tar_has_flag(tar_args, long_flags, short_flags):
+  """Returns whether tar_args include one of long_flags, or one of the
+  characters in short_flags as a short flag.
+  """
+  for arg in tar_args:
+    if arg.startswith('--'):
+      if arg.split('=', 1)[0] in long_flags:
+        return True
+    elif arg.startswith('-'):
+      for c in arg[1:]:
+        if c in short_flags:
+          return True
+        if c in _TAR_SHORT_FLAGS_WITH_ARG:
+          break
+  return False
+
+
+def tar_decompresses(tar_args):
+  """Returns whether tar_args ask tar to use a particular decompressor."""
+  return tar_has_flag(tar_args, _TAR_COMPRESSION_FLAGS,
+                      _TAR_COMPRESSION_SHORT_FLAGS)
+
+
+@contextlib.contextmanager
+def counted(tar_args, options):
+  """Yields tar_args for extracting, with flags added to have tar list what
+  it extracts if options['totals'] is a Counter. Once tar is done, adds the
+  number of files (non-directories) and their bytes to it, as 'files' and
+  'bytes'.
+
+  These are counts of what this archive contained, rather than of what is
+  on disk afterwards, which may have been there already or come from
+  another archive. If tar_args ask for -v, the names are printed as usual.
+  """
+  totals = options['totals']
+  if totals is None:
+    yield tar_args
+    return
+  verbose = tar_has_flag(tar_args, ('--verbose',), 'v')
+  with tempfile.NamedTemporaryFile(mode='r', prefix='untar-listing.',
+                                   errors='surrogateescape') as listing:
+    # -vv lists each member like ls -l: mode, owner, size, date, time, name.
+    yield tar_args + ['-vv', '--index-file=' + listing.name]
+    for line in listing:
+      fields = line.rstrip('\n').split(None, 5)
+      if len(fields) < 6:
+        continue
+      if verbose:
+        print(fields[5])
+      if fields[0].startswith('d'):
+        continue
+      totals['files'] += 1
+      # Device files have "major,minor" instead of a size.
+      if fields[2].isdigit():
+        totals['bytes'] += int(fields[2])
+
+
+def decompress_command(tar_file, tar_args, options):
+  """Returns the command to decompress tar_file to stdout in parallel, or
+  None to leave decompression to tar.
+  """
+  if options['decompressor'] == 'tar' or tar_decompresses(tar_args):
+    return None
+  fmt = compression_format(tar_file)
+  threads = str(options['threads'] or os.cpu_count() or 1)
+  for name, cmd in _DECOMPRESSORS.get(fmt, []):
+    if options['decompressor'] not in (None, name):
+      continue
+    if shutil.which(cmd[0]):
+      return [arg.format(threads=threads) for arg in cmd] + [tar_file]
+  if options['decompressor'] is not None:
+    raise ValueError("'%s' can't decompress '%s' (format: %s)" %
+                     (options['decompressor'], tar_file, fmt))
+  return None
+
+
+def start_tar(tar_args, tar_file, options, **kwargs):
+  """Starts tar on tar_file, reading through a parallel decompressor if
+  there's one for its format.
+
+  Args:
+    tar_args: [str] Args for tar, not including -f.
+    kwargs: Passed on to subprocess.Popen for tar.
+  Returns: (subprocess.Popen, subprocess.Popen) tar and the decompressor
+           feeding it (or None).
+  """
+  cmd = decompress_command(tar_file, tar_args, options)
+  if cmd is None:
+    return subprocess.Popen([_TAR] + tar_args + ['-f', tar_file], **kwargs), None
+  decompressor = subprocess.Popen(cmd, stdout=subprocess.PIPE)
+  try:
+    tar = subprocess.Popen([_TAR] + tar_args + ['-f', '-'],
+                           stdin=decompressor.stdout, **kwargs)
+  except OSError:
+    decompressor.kill()
+    decompressor.wait()
+    raise
+  finally:
+    decompressor.stdout.close()
+  return tar, decompressor
+
+
+def finish_tar(tar, decompressor):
+  """Waits for the processes from start_tar(). Returns tar's exit code, or
+  the decompressor's if only it failed.
+  """
+  tar.wait()
+  if decompressor is None:
+    return tar.returncode
+  decompressor.wait()
+  # tar stops reading at the end-of-archive marker, so the decompressor may
+  # be left writing trailing padding into a closed pipe.
+  if tar.returncode or decompressor.returncode in (0, -signal.SIGPIPE):
+    return tar.returncode
+  error('%s exited with status %d' % (decompressor.args[0],
+                                      decompressor.returncode))
+  return 2
+
+
+class ListError(Exception):
+  """tar couldn't list an archive. The message is tar's stderr."""
+
+
+def tar_list(tar_file, options):
+  """Yields the name of each file in the given tar file, as tar lists them.
+
+  If the caller stops early (and closes the generator), tar is killed
+  rather than left to read the rest of the archive.
+
+  Raises: ListError if tar fails.
+  """
+  # tar's stderr goes to a file, so that tar can't block on it while we
+  # only read stdout.
+  with tempfile.TemporaryFile(mode='w+') as stderr:
+    proc, decompressor = start_tar(['-t'], tar_file, options,
+                                   stdout=subprocess.PIPE, stderr=stderr,
+                                   universal_newlines=True,
+                                   errors='surrogateescape')
+    finished = False
+    try:
+      for line in proc.stdout:
+        yield line.rstrip('\n')
+      finished = True
+    finally:
+      proc.stdout.close()
+      if not finished:
+        for p in (proc, decompressor):
+          if p is not None:
+            p.kill()
+            p.wait()
+    if finish_tar(proc, decompressor):
+      stderr.seek(0)
+      raise ListError(stderr.read())
+
+
+def base_directory(path):
+  """Returns the first directory component of path (or the filename, if
+  there is none), or None for the archive's root itself.
+  """
+  # We need to account for absolute paths
+  if path.startswith(os.sep):
+    return os.sep + path.split(os.sep, 2)[1]
+  # Archives made with 'tar -cf x.tar .' list './', './a', './b/c'...
+  while path.startswith('.' + os.sep):
+    path = path[2:].lstrip(os.sep)
+  if path in ('', '.'):
+    return None
+  return path.split(os.sep, 1)[0]
 
 
-def base_directories(paths):
-  """Given a list of paths, returns the first directory component (or the
-  filename, if there is none) of each.
+def top_level_entries(paths, limit=2):
+  """Returns the distinct top-level components of paths. Stops reading paths
+  as soon as it has found limit of them.
   """
-  dirs = set()
+  entries = set()
   for path in paths:
-    # We need to account for absolute paths
-    if path.startswith(os.sep):
-      dirs.add(os.sep + path.split(os.sep, 2)[1])
-    else:
-      dirs.add(path.split(os.sep, 1)[0])
-  return dirs
+    base = base_directory(path)
+    if base is not None:
+      entries.add(base)
+      if len(entries) >= limit:
+        break
+  return entries
 
 
 def archive_name(archive_path):
@@ -67,7 +323,7 @@ def archive_name(archive_path):
   return re.sub(r'\.(tar|tar\.\w+|tgz|tbz2)$', '', base, 1)
 
 
-def untar(tar_file, extra_args, directory):
+def untar(tar_file, extra_args, directory, options):
   """Untars a file.
 
   Args:
@@ -77,41 +333,369 @@ def untar(tar_file, extra_args, directory):
   Returns:
     exit code from tar
   """
-  cmd = [_TAR] + extra_args + ['-xf', tar_file]
+  args = extra_args + ['-x']
   if directory is not None:
-    cmd += ['-C', directory]
-  proc = subprocess.Popen(cmd)
-  proc.communicate()
-  return proc.returncode
+    args += ['-C', directory]
+  with counted(args, options) as args:
+    if options['index']:
+      return untar_indexed(tar_file, args, options)
+    return finish_tar(*start_tar(args, tar_file, options))
 
 
-def usage():
-  usage_str = ('Usage: %s [FLAGS] TARFILE\n\n'
-               'Untars TARFILE to a subdirectory of the CWD. If the TARFILE\n'
-               'will naturally expand only to a single subdirecory, that one\n'
-               'is used. Otherwise, the name of the directory without a\n'
-               'suffix is used.\n\n'
-               'Any FLAGS are passed straight to tar.' % sys.argv[0])
-  print(usage_str, file=sys.stderr)
+class _Tee(object):
+  """A file-like object that copies whatever is read from src to dest."""
 
+  def __init__(self, src, dest):
+    self.src = src
+    self.dest = dest
 
-def error(msg):
-  print('%s: %s' % (sys.argv[0], msg), file=sys.stderr)
+  def read(self, size=-1):
+    data = self.src.read(size)
+    self.dest.write(data)
+    return data
 
+  def drain(self):
+    while self.read(_BUFSIZE):
+      pass
 
-def main(argv):
-  if len(argv) < 2:
-    usage()
+
+def untar_indexed(tar_file, tar_args, options):
+  """Runs tar_args on tar_file like untar(), and writes an index of its
+  members on the way.
+
+  The (decompressed) archive goes through us on its way to tar, and
+  tarfile reads the headers out of it: we only need the offset of each
+  member, and tar still does the extracting.
+
+  Returns:
+    exit code from tar
+  """
+  fmt = compression_format(tar_file)
+  cmd = decompress_command(tar_file, tar_args, options)
+  if cmd is None and fmt is not None:
+    cmd = _DECOMPRESS[fmt] + [tar_file]
+  try:
+    fh = open(tar_file, 'rb')
+  except (IOError, OSError) as e:
+    error("Could not open '%s': %s" % (tar_file, e))
     return 2
-  tar_file = argv[-1]
-  flags = argv[1:-1]
+  with fh:
+    st = os.fstat(fh.fileno())
+    decompressor = None
+    src = fh
+    if cmd is not None:
+      decompressor = subprocess.Popen(cmd, stdout=subprocess.PIPE)
+      src = decompressor.stdout
+    tar = subprocess.Popen([_TAR] + tar_args + ['-f', '-'],
+                           stdin=subprocess.PIPE)
+    members = []
+    try:
+      tee = _Tee(src, tar.stdin)
+      try:
+        archive = tarfile.open(fileobj=tee, mode='r|', bufsize=_BUFSIZE)
+        while True:
+          info = archive.next()
+          if info is None:
+            break
+          link = info.linkname if info.islnk() else None
+          members.append((info.name, info.offset, link))
+          # tarfile keeps every member it has read; we don't need them.
+          archive.members = []
+      except tarfile.TarError as e:
+        error("Couldn't index '%s': %s" % (tar_file, e))
+        members = None
+      tee.drain()
+    except BrokenPipeError:
+      # tar gave up early; it will say why.
+      members = None
+    finally:
+      try:
+        tar.stdin.close()
+      except BrokenPipeError:
+        pass
+      if decompressor is not None:
+        decompressor.stdout.close()
+    returncode = finish_tar(tar, decompressor)
+    if returncode or members is None:
+      return returncode
+    try:
+      write_index(tar_file, st, fmt, checkpoints(fh, fmt), members)
+    except (IOError, OSError) as e:
+      error("Couldn't write an index for '%s': %s" % (tar_file, e))
+  return 0
+
+
+def checkpoints(fh, fmt):
+  """Returns [(compressed offset, uncompressed offset)] of some of the
+  places where decompression of fh can start afresh, in order.
+  """
+  points = [(0, 0)]
+  if fmt == 'gzip':
+    restarts = gzip_members(fh)
+  elif fmt == 'zstd':
+    restarts = zstd_frames(fh)
+  else:
+    return points
+  for coffset, uoffset in restarts:
+    if uoffset - points[-1][1] >= _CHECKPOINT_SPACING:
+      points.append((coffset, uoffset))
+  return points
+
+
+def gzip_members(fh):
+  """Yields (compressed offset, uncompressed offset) of each member of a
+  gzip file, for as long as the members are BGZF blocks: those record their
+  own length, so we can skip from one to the next without decompressing.
+  """
+  coffset, uoffset = 0, 0
+  while True:
+    fh.seek(coffset)
+    header = fh.read(12)
+    # Magic, deflate, and FEXTRA set.
+    if len(header) < 12 or header[:3] != b'\x1f\x8b\x08' or not header[3] & 4:
+      return
+    extra = fh.read(struct.unpack('<H', header[10:12])[0])
+    size = None
+    while len(extra) >= 4:
+      sub_len = struct.unpack('<H', extra[2:4])[0]
+      if extra[:2] == b'BC' and sub_len == 2:
+        size = struct.unpack('<H', extra[4:6])[0] + 1
+      extra = extra[4 + sub_len:]
+    if size is None:
+      return
+    fh.seek(coffset + size - 4)
+    trailer = fh.read(4)
+    if len(trailer) < 4:
+      return
+    yield coffset, uoffset
+    coffset += size
+    uoffset += struct.unpack('<I', trailer)[0]
+
+
+def zstd_frames(fh):
+  """Yields (compressed offset, uncompressed offset) of each zstd frame, for
+  as long as the frames record their decompressed size. Block headers say
+  how big each block is, so this doesn't need to decompress anything.
+  """
+  coffset, uoffset = 0, 0
+  while True:
+    fh.seek(coffset)
+    header = fh.read(18)
+    if len(header) < 8:
+      return
+    magic = struct.unpack('<I', header[:4])[0]
+    if magic & 0xfffffff0 == 0x184d2a50:
+      # A skippable frame, e.g. a seek table.
+      coffset += 8 + struct.unpack('<I', header[4:8])[0]
+      continue
+    if magic != 0xfd2fb528:
+      return
+    descriptor = header[4]
+    single_segment = descriptor & 0x20
+    fcs_size = [1 if single_segment else 0, 2, 4, 8][descriptor >> 6]
+    if not fcs_size:
+      return
+    pos = 5 + (0 if single_segment else 1) + [0, 1, 2, 4][descriptor & 3]
+    content_size = int.from_bytes(header[pos:pos + fcs_size], 'little')
+    if fcs_size == 2:
+      content_size += 256
+    yield coffset, uoffset
+    # Walk the blocks to find the end of the frame.
+    block = coffset + pos + fcs_size
+    while True:
+      fh.seek(block)
+      block_header = fh.read(3)
+      if len(block_header) < 3:
+        return
+      value = int.from_bytes(block_header, 'little')
+      block_type, block_size = (value >> 1) & 3, value >> 3
+      block += 3 + (1 if block_type == 1 else block_size)
+      if value & 1:
+        break
+    coffset = block + (4 if descriptor & 4 else 0)
+    uoffset += content_size
+
+
+def index_path(tar_file):
+  return tar_file + _INDEX_SUFFIX
+
+
+def member_key(name):
+  """Normalizes a member name, the way tar matches them."""
+  while name.startswith('./'):
+    name = name[2:]
+  return name.strip('/')
+
+
+def write_index(tar_file, st, fmt, points, members):
+  """Writes the index for tar_file: a JSON header line, then one
+  [key, offset, name, hard link target] line per member.
+  """
+  path = index_path(tar_file)
+  with open(path + '.tmp', 'w') as fh:
+    fh.write(json.dumps({'size': st.st_size, 'mtime': st.st_mtime_ns,
+                         'format': fmt, 'checkpoints': points}) + '\n')
+    for name, offset, link in members:
+      fh.write(json.dumps([member_key(name), offset, name, link]) + '\n')
+  os.rename(path + '.tmp', path)
+
+
+def read_index(tar_file, keys):
+  """Looks keys up in tar_file's index.
 
-  files, stderr = tar_list(tar_file)
-  if files is None:
-    error("Could not parse tar file listing for '%s':\n%s" % (tar_file, stderr))
+  Returns: (dict, {str: (int, str, str)}) The index header, and for each
+           key found, the last member's (offset, name, hard link target).
+           None if there's no up-to-date index.
+  """
+  try:
+    fh = open(index_path(tar_file))
+  except (IOError, OSError):
+    return None
+  with fh:
+    header = json.loads(fh.readline())
+    st = os.stat(tar_file)
+    if (header['size'], header['mtime']) != (st.st_size, st.st_mtime_ns):
+      return None
+    # Most lines won't be a match, and can be ruled out without parsing.
+    prefixes = tuple(json.dumps([key])[:-1] + ',' for key in keys)
+    found = {}
+    for line in fh:
+      if line.startswith(prefixes):
+        key, offset, name, link = json.loads(line)
+        found[key] = (offset, name, link)
+  return header, found
+
+
+def untar_member(tar_file, offset, name, fmt, points, extra_args, options):
+  """Untars the member called name, whose header is at offset.
+
+  Returns:
+    exit code from tar
+  """
+  if fmt is None:
+    # An uncompressed archive can be read from anywhere.
+    coffset, uoffset = offset, offset
+  else:
+    coffset, uoffset = max(p for p in points if p[1] <= offset)
+  with open(tar_file, 'rb') as fh:
+    fh.seek(coffset)
+    decompressor = None
+    src = fh
+    if fmt is not None:
+      decompressor = subprocess.Popen(_DECOMPRESS[fmt], stdin=fh,
+                                      stdout=subprocess.PIPE)
+      src = decompressor.stdout
+    skip = offset - uoffset
+    while skip:
+      data = src.read(min(skip, _BUFSIZE))
+      if not data:
+        break
+      skip -= len(data)
+    with counted(extra_args + ['-x', '--occurrence=1'], options) as args:
+      # tar stops reading once it has the member.
+      tar = subprocess.Popen([_TAR] + args + ['-f', '-', '--add-file=' + name],
+                             stdin=subprocess.PIPE)
+      try:
+        shutil.copyfileobj(src, tar.stdin, _BUFSIZE)
+        tar.stdin.close()
+      except BrokenPipeError:
+        pass
+      if decompressor is not None:
+        decompressor.stdout.close()
+        decompressor.kill()
+        decompressor.wait()
+      return tar.wait()
+
+
+def untar_members(tar_file, extra_args, options):
+  """Untars just the --member files, using the index if there is one.
+
+  Returns:
+    exit code: the highest of the tar runs'
+  """
+  keys = [member_key(m) for m in options['members']]
+  index = read_index(tar_file, keys)
+  if index is None:
+    error("No up-to-date index for '%s' (make one with --index); reading "
+          "the whole archive" % tar_file)
+    return untar(tar_file, extra_args + ['--add-file=' + m
+                                         for m in options['members']],
+                 None, options)
+  header, found = index
+  returncode = 0
+  for key in keys:
+    if key not in found:
+      error("'%s' isn't in '%s'" % (key, tar_file))
+      returncode = max(returncode, 1)
+      continue
+    offset, name, link = found[key]
+    todo = [(offset, name)]
+    if link is not None:
+      # A hard link needs its target to be there first.
+      target = read_index(tar_file, [member_key(link)])[1].get(
+          member_key(link))
+      if target is not None:
+        todo.insert(0, target[:2])
+    for offset, name in todo:
+      returncode = max(returncode, untar_member(
+          tar_file, offset, name, header['format'],
+          [tuple(p) for p in header['checkpoints']], extra_args, options))
+  return returncode
+
+
+def untar_single_pass(tar_file, extra_args, options):
+  """Untars a file, reading it only once.
+
+  The archive is extracted into a fresh staging directory in the CWD, so
+  that we can look at what it contains before anything appears under its
+  final name. Then a single rename moves it into place: the archive's one
+  top-level entry, if it has just one, or else the whole staging directory
+  as archive_name().
+
+  Args:
+    extra_args: [str] Extra args to add, before the filename.
+  Returns:
+    exit code
+  """
+  staging = tempfile.mkdtemp(prefix='.untar-', dir='.')
+  keep = False
+  try:
+    returncode = untar(tar_file, extra_args, staging, options)
+    if returncode:
+      return returncode
+    entries = os.listdir(staging)
+    if len(entries) == 1:
+      src, dest = os.path.join(staging, entries[0]), entries[0]
+    else:
+      src, dest = staging, archive_name(tar_file)
+      # mkdtemp() makes the directory private; give it the usual mode.
+      os.chmod(staging, 0o777 & ~get_umask())
+    if os.path.lexists(dest):
+      error("'%s' already exists; left the extracted files in '%s'" %
+            (dest, staging))
+      keep = True
+      return 1
+    os.rename(src, dest)
+    return 0
+  finally:
+    if not keep and os.path.isdir(staging):
+      shutil.rmtree(staging)
+
+
+def untar_listed(tar_file, extra_args, options):
+  """Untars a file, listing it first to see whether it's a tarbomb.
+
+  Returns:
+    exit code
+  """
+  try:
+    with contextlib.closing(tar_list(tar_file, options)) as files:
+      entries = top_level_entries(files)
+  except ListError as e:
+    error("Could not parse tar file listing for '%s':\n%s" % (tar_file, e))
     return 1
 
-  if len(base_directories(files)) > 1:
+  if len(entries) > 1:
     base = archive_name(tar_file)
     try:
       os.mkdir(base)
@@ -120,6 +704,250 @@ def main(argv):
       return 1
   else:
     base = None
-  return untar(tar_file, extra_args=flags, directory=base)
+  return untar(tar_file, extra_args, base, options)
+
+
+def extract(tar_file, extra_args, options):
+  if options['members']:
+    return untar_members(tar_file, extra_args, options)
+  if options['single_pass']:
+    return untar_single_pass(tar_file, extra_args, options)
+  return untar_listed(tar_file, extra_args, options)
+
+
+@functools.lru_cache()
+def get_umask():
+  # Setting the umask isn't thread safe, so this has to be called before
+  # any threads start.
+  mask = os.umask(0)
+  os.umask(mask)
+  return mask
+
+
+def is_rotational(dev):
+  """Returns whether the filesystem on device dev (an st_dev) is on a
+  spinning disk, as far as sysfs knows.
+  """
+  sys_dir = '/sys/dev/block/%d:%d' % (os.major(dev), os.minor(dev))
+  # A partition's queue settings are those of its disk, one level up.
+  for queue in ('queue', '../queue'):
+    try:
+      with open(os.path.join(sys_dir, queue, 'rotational')) as fh:
+        return fh.read().strip() == '1'
+    except (IOError, OSError):
+      pass
+  return False
+
+
+class Scheduler(object):
+  """Hands out archives to extract, with at most limits[dev] of them at a
+  time reading from or writing to each device.
+  """
+
+  def __init__(self, jobs, limits):
+    # jobs is a list of (tar_file, devices) in the order to start them.
+    self.pending = list(jobs)
+    self.limits = limits
+    self.running = collections.Counter()
+    self.cond = threading.Condition()
+
+  def take(self):
+    """Waits for the next archive that its devices have room for. Returns
+    (tar_file, devices), or None when there are none left.
+    """
+    with self.cond:
+      while self.pending:
+        for i, (tar_file, devices) in enumerate(self.pending):
+          if all(self.running[d] < self.limits[d] for d in devices):
+            del self.pending[i]
+            self.running.update(devices)
+            return tar_file, devices
+        self.cond.wait()
+      return None
+
+  def done(self, devices):
+    with self.cond:
+      self.running.subtract(devices)
+      self.cond.notify_all()
+
+  def cancel(self):
+    with self.cond:
+      self.pending = []
+      self.cond.notify_all()
+
+
+def extract_all(tar_files, extra_args, options):
+  """Untars several files at once, and prints a report.
+
+  Up to --jobs archives are extracted at a time, and at most --per-fs-jobs
+  of them read from or write to any one filesystem. By default that's one
+  per spinning disk, where extractions would just fight over the heads,
+  and unlimited otherwise.
+
+  Returns:
+    exit code: the highest of the archives'
+  """
+  get_umask()
+  target_dev = os.stat('.').st_dev
+  jobs, limits = [], {}
+  for tar_file in tar_files:
+    devices = set([target_dev])
+    try:
+      devices.add(os.stat(tar_file).st_dev)
+    except OSError:
+      pass  # tar will complain.
+    for dev in devices:
+      if dev not in limits:
+        if options['per_fs_jobs']:
+          limits[dev] = options['per_fs_jobs']
+        else:
+          limits[dev] = 1 if is_rotational(dev) else len(tar_files)
+    jobs.append((tar_file, devices))
+  scheduler = Scheduler(jobs, limits)
+  workers = min(options['jobs'] or os.cpu_count() or 1, len(tar_files))
+  if not options['threads']:
+    # Share the CPUs out between the decompressors.
+    options = dict(options, threads=max(1, (os.cpu_count() or 1) // workers))
+
+  results = {}
+  def work():
+    while True:
+      job = scheduler.take()
+      if job is None:
+        return
+      tar_file, devices = job
+      start = time.time()
+      totals = collections.Counter()
+      try:
+        returncode = extract(tar_file, extra_args,
+                             dict(options, totals=totals))
+        files, size = totals['files'], totals['bytes']
+      except Exception as e:
+        error("'%s': %s" % (tar_file, e))
+        returncode, files, size = 1, 0, 0
+      finally:
+        scheduler.done(devices)
+      results[tar_file] = (returncode, files, size, time.time() - start)
+
+  start = time.time()
+  threads = [threading.Thread(target=work) for _ in range(workers)]
+  for t in threads:
+    t.start()
+  interrupted = False
+  for t in threads:
+    while t.is_alive():
+      try:
+        t.join()
+      except KeyboardInterrupt:
+        # tar got the SIGINT too; let the running ones clean up.
+        interrupted = True
+        scheduler.cancel()
+
+  width = max(len(f) for f in tar_files)
+  print('%-*s %6s %10s %10s %9s' % (width, 'archive', 'status', 'files',
+                                    'MiB', 'time (s)'))
+  total_files, total_size = 0, 0
+  for tar_file in tar_files:
+    if tar_file not in results:
+      print('%-*s %6s' % (width, tar_file, '-'))
+      continue
+    returncode, files, size, seconds = results[tar_file]
+    total_files += files
+    total_size += size
+    print('%-*s %6d %10d %10.1f %9.2f' % (width, tar_file, returncode, files,
+                                          size / 2.0**20, seconds))
+  failed = sum(1 for r in results.values() if r[0])
+  print('%-*s %6s %10d %10.1f %9.2f' % (
+      width, 'total (%d failed)' % failed, '', total_files,
+      total_size / 2.0**20, time.time() - start))
+  if interrupted:
+    return 130
+  return max(r[0] for r in results.values()) if results else 1
+
+
+def parse_flags(args):
+  """Separates our own flags from the ones for tar, and the archives.
+
+  Returns: (dict, [str], [str]) Our options, the flags to pass to tar, and
+           the archives.
+  Raises: ValueError if one of our flags has a bad value.
+  """
+  options = {'single_pass': False, 'threads': 0, 'decompressor': None,
+             'jobs': 0, 'per_fs_jobs': 0, 'index': False, 'members': [],
+             'totals': None}
+  tar_flags = []
+  tar_files = []
+  for flag in args:
+    name, _, value = flag.partition('=')
+    if not flag.startswith('-'):
+      tar_files.append(flag)
+    elif flag == '--single-pass':
+      options['single_pass'] = True
+    elif flag == '--index':
+      options['index'] = True
+    elif name == '--member' and value:
+      options['members'].append(value)
+    elif name in ('--threads', '--jobs', '--per-fs-jobs'):
+      if not value.isdigit():
+        raise ValueError('%s needs a number, not %r' % (name, value))
+      options[name[2:].replace('-', '_')] = int(value)
+    elif name == '--decompressor':
+      names = set(n for tools in _DECOMPRESSORS.values() for n, _ in tools)
+      if value != 'tar' and value not in names:
+        raise ValueError('--decompressor must be one of: %s' %
+                         ', '.join(sorted(names | set(['tar']))))
+      options['decompressor'] = value
+    else:
+      tar_flags.append(flag)
+  if options['index'] and options['members']:
+    raise ValueError("--index and --member don't go together")
+  if options['index'] and tar_decompresses(tar_flags):
+    raise ValueError("--index needs to do the decompressing itself; leave "
+                     "out tar's compression flags")
+  return options, tar_flags, tar_files
+
+
+def usage():
+  usage_str = ('Usage: %s [FLAGS] TARFILE...\n\n'
+               'Untars TARFILE to a subdirectory of the CWD. If the TARFILE\n'
+               'will naturally expand only to a single subdirecory, that one\n'
+               'is used. Otherwise, the name of the directory without a\n'
+               'suffix is used.\n\n'
+               '--single-pass extracts into a staging directory and renames\n'
+               'the result into place, instead of listing TARFILE first.\n'
+               '--threads=N sets the threads for parallel decompression.\n'
+               "--decompressor=NAME picks the decompressor (or 'tar').\n"
+               'With several TARFILEs, --jobs=N extracts up to N at once, and\n'
+               '--per-fs-jobs=N at most N per filesystem (default: 1 on\n'
+               'spinning disks).\n'
+               '--index also writes TARFILE%s, which lets later\n'
+               '--member=PATH runs extract PATH without reading the whole\n'
+               'archive.\n\n'
+               'Any other FLAGS are passed straight to tar. Values for them\n'
+               'must be attached, as in --exclude=PATTERN.' %
+               (sys.argv[0], _INDEX_SUFFIX))
+  print(usage_str, file=sys.stderr)
+
+
+def error(msg):
+  print('%s: %s' % (sys.argv[0], msg), file=sys.stderr)
+
+
+def main(argv):
+  try:
+    options, flags, tar_files = parse_flags(argv[1:])
+    for tar_file in tar_files:
+      decompress_command(tar_file, flags, options)
+  except ValueError as e:
+    error(e)
+    return 2
+  if not tar_files:
+    usage()
+    return 2
+
+  if len(tar_files) > 1:
+    return extract_all(tar_files, extra_args=flags, options=options)
+  return extract(tar_files[0], extra_args=flags, options=options)
 
-sys.exit(main(sys.argv))
+if __name__ == '__main__':
+  sys.exit(main(sys.argv))